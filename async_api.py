@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous API - same services as the API (index.py) : /search, /index, /explore and /reference.
+Searches are sent to ElasticSearch with a non-blocking client and a pool of connections,
+so a process handles thousands of concurrent searches, without one thread per search.
+A search is cancelled when its client disconnects, and bounded by a timeout (ES_TIMEOUT seconds).
+
+Run :
+    HOST=<ip> PORT=<port> USERNAME=<username> PASSWORD=<password> python async_api.py
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import asyncio
+import functools
+import cache
+import engine
+import suggest
+import clients
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from elasticsearch_async import AsyncElasticsearch
+from rq import Queue
+
+# elasticsearch connections : pool size and timeout of a search (seconds)
+ES_MAXSIZE = int(os.getenv("ES_ASYNC_MAXSIZE", 500))
+ES_TIMEOUT = float(os.getenv("ES_TIMEOUT", 10))
+
+# threads running blocking calls (redis, language detection of queries), out of the event loop
+ASYNC_THREADS = int(os.getenv("ASYNC_THREADS", 64))
+
+# crawl backend : "rq" (one rq job per crawl) or "daemon" (long-lived crawl daemon, see crawl_daemon.py)
+CRAWL_BACKEND = os.getenv("CRAWL_BACKEND", "rq")
+
+def invalid_usage(message, status=400) :
+    """
+    JSON invalid usage error, as in API.
+    """
+    return web.json_response({"message":message}, status=status)
+
+async def blocking(request, func, *args) :
+    """
+    Run a blocking call (redis, language detection) in the thread pool of application.
+    """
+    return await asyncio.get_event_loop().run_in_executor(request.app["executor"], functools.partial(func, *args))
+
+def search_plan(data) :
+    """
+    Search plan and elasticsearch query of a search request (language detection is CPU bound).
+    """
+    with metrics.timer("query_build") :
+        plan = engine.plan(data)
+        return plan, engine.body(plan)
+
+async def search(request) :
+    """
+    URL : /search
+    Query engine to find a list of relevant URLs (see API).
+    """
+    data = await request.post()
+    try :
+        plan, body = await blocking(request, search_plan, data)
+    except ValueError as e :
+        return invalid_usage(str(e))
+
+    # get results from cache, if any
+    redis_conn = clients.redis_conn
+    cache_key = await blocking(request, cache.key, redis_conn, engine.cache_indices(plan), plan["query"], plan["domain"], plan["start"], plan["hits"])
+    cached = await blocking(request, cache.get, redis_conn, cache_key)
+    if cached is not None :
+        return web.json_response(cached)
+
+    es = request.app["es"]
+    async def run_search(index) :
+        with metrics.timer("es_search") :
+            response = await es.search(index=index, doc_type="page", body=body, from_=plan["start"], size=plan["hits"],
+                ignore_unavailable=True, request_timeout=ES_TIMEOUT)
+        took = response.get("took", 0)
+        metrics.observe("es_took", took / 1000.0)
+        with metrics.timer("format") :
+            return engine.results(plan, response) + (took,)
+
+    total, results, took = await run_search(plan["index"])
+    if plan["detected"] and not total :
+        # no result in detected language, probably a wrong detection : search in all languages
+        total, results, fallback_took = await run_search(engine.ALL_INDICES)
+        took += fallback_took
+    await blocking(request, cache.put, redis_conn, cache_key, {"total":total, "results":results})
+
+    # time spent in ElasticSearch (milliseconds), for load tests
+    return web.json_response({"total":total, "results":results}, headers={"X-Search-Took":str(took)})
+
+def crawl_service(type_, fields, message) :
+    """
+    Service queuing a crawl job ("index", "explore" or "reference") from form fields.
+    """
+    async def service(request) :
+        data = await request.post()
+        if any(field not in data for field in fields) :
+            return invalid_usage('No %s specified in POST data'%" or ".join(fields))
+        args = [data[field] for field in fields]
+        if CRAWL_BACKEND == "daemon" and type_ != "reference" :
+            import crawl_daemon
+            await blocking(request, crawl_daemon.submit, clients.redis_conn, type_, args[0])
+        else :
+            queue = Queue(connection=clients.redis_conn)
+            await blocking(request, queue.enqueue, "index.%s_job"%type_, *args)
+        return web.Response(text=message)
+    return service
+
+async def suggest_service(request) :
+    """
+    URL : /suggest
+    Query autocomplete (see API).
+    """
+    data = request.query if request.method == "GET" else await request.post()
+    try :
+        prefix, index, size = suggest.plan(data)
+    except ValueError as e :
+        return invalid_usage(str(e))
+    key = (index, prefix, size)
+    suggestions = suggest.cache.get(key)
+    if suggestions is None :
+        response = await request.app["es"].search(index=index, body=suggest.body(prefix, size), ignore_unavailable=True, request_timeout=ES_TIMEOUT)
+        suggestions = suggest.options(response, size)
+        suggest.cache.put(key, suggestions)
+    return web.json_response({"suggestions":suggestions})
+
+async def metrics_service(request) :
+    """
+    URL : /metrics
+    Metrics of search engine, in the Prometheus text format.
+    """
+    text = await blocking(request, metrics.render, clients.redis_conn)
+    return web.Response(text=text, content_type="text/plain")
+
+async def open_executor(app) :
+    app["executor"] = ThreadPoolExecutor(max_workers=ASYNC_THREADS)
+
+async def close_executor(app) :
+    app["executor"].shutdown(wait=True)
+
+async def open_es(app) :
+    hosts = [os.getenv("HOST")]
+    http_auth = (os.getenv("USERNAME"), os.getenv("PASSWORD"))
+    port = os.getenv("PORT")
+    app["es"] = AsyncElasticsearch(hosts=hosts, http_auth=http_auth, port=port, maxsize=ES_MAXSIZE, timeout=ES_TIMEOUT)
+
+async def close_es(app) :
+    await app["es"].transport.close()
+
+def create_app() :
+    """
+    Create the asynchronous API.
+    """
+    app = web.Application()
+    app.router.add_post("/search", search)
+    app.router.add_post("/index", crawl_service("index", ["url"], "Indexing started"))
+    app.router.add_post("/explore", crawl_service("explore", ["url"], "Exploration started"))
+    app.router.add_post("/reference", crawl_service("reference", ["url", "email"], "Referencing started"))
+    app.router.add_get("/suggest", suggest_service)
+    app.router.add_post("/suggest", suggest_service)
+    app.router.add_get("/metrics", metrics_service)
+    app.on_startup.append(open_executor)
+    app.on_startup.append(open_es)
+    app.on_cleanup.append(close_es)
+    app.on_cleanup.append(close_executor)
+    return app
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=int(os.getenv("API_PORT", 5000)))
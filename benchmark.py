@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark of page extraction - language detection, main content extraction, description
+and document build of the indexing pipeline, over a corpus of HTML pages.
+Everything runs in process : ElasticSearch and Redis are replaced by in-memory stand-ins,
+so results only depend on extraction code (and machine).
+Reports pages per second, latency of each stage (mean, p50, p95, p99) and peak memory,
+and compares them with a saved baseline (exit code 1 on regression).
+
+Usage :
+    python benchmark.py                             # generated corpus (BENCHMARK_PAGES pages, fixed seed)
+    python benchmark.py --corpus <dir>              # corpus of saved pages (*.html files)
+    python benchmark.py --generate <dir>            # write the generated corpus to a directory, to keep it
+    python benchmark.py --save <baseline.json>      # save results as baseline
+    python benchmark.py --compare <baseline.json>   # compare results with baseline
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tracemalloc
+
+# size of generated corpus, and tolerated slowdown (ratio) before a regression is reported
+BENCHMARK_PAGES = int(os.getenv("BENCHMARK_PAGES", 500))
+BENCHMARK_TOLERANCE = float(os.getenv("BENCHMARK_TOLERANCE", 0.2))
+
+# timed stages
+STAGES = ["parse", "detect_language", "extract_content", "create_description", "pipeline"]
+
+# vocabulary of generated pages
+WORDS = {
+    "fr":("le la les un une des et est dans pour que qui sur pas plus avec par ce il elle nous vous ils "
+          "monde pays ville gouvernement président élection économie entreprise travail santé école "
+          "semaine année jour nouvelle politique projet public national accord réforme crise marché "
+          "depuis selon après avant pendant toujours encore aussi très bien fait été avoir faire dire").split(),
+    "en":("the a an and is in for that which on not more with by this he she we you they "
+          "world country city government president election economy company work health school "
+          "week year day news policy project public national agreement reform crisis market "
+          "since according after before during always still also very well made been have make say").split()
+}
+BOILERPLATE = ["Home", "News", "Contact", "Subscribe", "Login", "Terms of use", "Privacy", "Share", "Follow us", "Copyright"]
+
+def to_bytes(value) :
+    if isinstance(value, bytes) :
+        return value
+    return str(value).encode("utf8")
+
+class MemoryRedis(object):
+    """
+    In-memory stand-in of a Redis client, for the commands used by the indexing pipeline.
+    """
+    def __init__(self) :
+        self.data = {}
+
+    def pipeline(self, transaction=True) :
+        return MemoryPipeline(self)
+
+    def get(self, key) :
+        return self.data.get(key)
+
+    def mget(self, keys) :
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None) :
+        self.data[key] = to_bytes(value)
+
+    def incrby(self, key, amount=1) :
+        value = int(self.data.get(key, 0)) + amount
+        self.data[key] = to_bytes(value)
+        return value
+
+    def incr(self, key, amount=1) :
+        return self.incrby(key, amount)
+
+    def decrby(self, key, amount=1) :
+        return self.incrby(key, -amount)
+
+    def delete(self, *keys) :
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def expire(self, key, seconds) :
+        return key in self.data
+
+    def exists(self, key) :
+        return int(key in self.data)
+
+    def hash(self, key) :
+        return self.data.setdefault(key, {})
+
+    def hget(self, key, field) :
+        return self.data.get(key, {}).get(to_bytes(field))
+
+    def hmget(self, key, fields) :
+        return [self.hget(key, field) for field in fields]
+
+    def hgetall(self, key) :
+        return dict(self.data.get(key, {}))
+
+    def hset(self, key, field, value) :
+        self.hash(key)[to_bytes(field)] = to_bytes(value)
+
+    def hsetnx(self, key, field, value) :
+        if to_bytes(field) in self.hash(key) :
+            return 0
+        self.hset(key, field, value)
+        return 1
+
+    def hmset(self, key, mapping) :
+        for field, value in mapping.items() :
+            self.hset(key, field, value)
+
+    def hincrby(self, key, field, amount=1) :
+        value = int(self.hget(key, field) or 0) + amount
+        self.hset(key, field, value)
+        return value
+
+    def hincrbyfloat(self, key, field, amount=1.0) :
+        value = float(self.hget(key, field) or 0) + amount
+        self.hset(key, field, value)
+        return value
+
+    def sadd(self, key, *members) :
+        self.data.setdefault(key, set()).update(to_bytes(member) for member in members)
+
+    def sismember(self, key, member) :
+        return to_bytes(member) in self.data.get(key, set())
+
+    def smembers(self, key) :
+        return set(self.data.get(key, set()))
+
+    def zadd(self, key, mapping, nx=False) :
+        zset = self.hash(key)
+        for member, score in mapping.items() :
+            if not (nx and to_bytes(member) in zset) :
+                zset[to_bytes(member)] = score
+
+class MemoryPipeline(object):
+    """
+    Pipeline of the Redis stand-in : commands are run at execute().
+    """
+    def __init__(self, redis_conn) :
+        self.redis_conn = redis_conn
+        self.commands = []
+
+    def __getattr__(self, name) :
+        command = getattr(self.redis_conn, name)
+        def queue(*args, **kwargs) :
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self) :
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+class MemorySink(object):
+    """
+    Stand-in of the bulk indexer : documents are serialized as for a bulk request, and kept.
+    Callbacks (freshness, thumbnails) are not run, they are not part of extraction.
+    """
+    def __init__(self) :
+        self.documents = 0
+        self.bytes = 0
+
+    def add(self, index, doc_type, id, body, callback=None) :
+        self.documents += 1
+        self.bytes += len(json.dumps(body))
+
+    def flush(self) :
+        return 0
+
+def sentence(rng, words, size) :
+    return " ".join(rng.choice(words) for i in range(size)).capitalize() + "."
+
+def generate(count, seed=0) :
+    """
+    Generate a corpus of pages (fixed seed) : (url, html) of French and English news-like pages,
+    with navigation and footer boilerplate, meta description for some pages, <html lang> for half of pages.
+    """
+    rng = random.Random(seed)
+    pages = []
+    for i in range(count) :
+        lang = "fr" if i % 2 else "en"
+        words = WORDS[lang]
+        title = sentence(rng, words, rng.randint(4, 10))
+        description = sentence(rng, words, rng.randint(10, 25)) if i % 3 else ""
+        paragraphs = ["<p>%s</p>"%" ".join(sentence(rng, words, rng.randint(8, 30)) for j in range(rng.randint(2, 6)))
+            for k in range(rng.randint(3, 40))]
+        links = "".join('<li><a href="/%s">%s</a></li>'%(name.lower().replace(" ", "-"), name) for name in BOILERPLATE)
+        pages.append(("http://www.site%s.com/article/%s.html"%(i % 20, i),
+            '<!DOCTYPE html><html%s><head><meta charset="utf-8"><title>%s</title>%s</head>'
+            '<body><nav><ul>%s</ul></nav><article><h1>%s</h1>%s</article><footer><ul>%s</ul></footer>'
+            '<script>var tracking = {"page":%s};</script></body></html>'%(
+                ' lang="%s"'%lang if i % 4 < 2 else "", title,
+                '<meta name="description" content="%s">'%description if description else "",
+                links, title, "".join(paragraphs), links, i)))
+    return pages
+
+def load(directory) :
+    """
+    Load a corpus of saved pages (*.html files, url of page is built from file name).
+    """
+    pages = []
+    for name in sorted(os.listdir(directory)) :
+        if name.endswith(".html") :
+            with open(os.path.join(directory, name), "rb") as f :
+                pages.append(("http://%s"%name[:-len(".html")].replace("_", "/"), f.read().decode("utf8", "ignore")))
+    return pages
+
+def save(pages, directory) :
+    """
+    Write a corpus to a directory (one file per page).
+    """
+    if not os.path.isdir(directory) :
+        os.makedirs(directory)
+    for link, html in pages :
+        with open(os.path.join(directory, "%s.html"%link[len("http://"):].replace("/", "_")), "wb") as f :
+            f.write(html.encode("utf8"))
+
+def summary(durations) :
+    """
+    Mean and percentiles of a list of durations (milliseconds).
+    """
+    durations = sorted(durations)
+    if not durations :
+        return {}
+    percentile = lambda q : durations[int(q * (len(durations) - 1))] * 1000
+    return {
+        "mean":sum(durations) / len(durations) * 1000,
+        "p50":percentile(0.5),
+        "p95":percentile(0.95),
+        "p99":percentile(0.99)
+    }
+
+def run_pass(pages, stages=None) :
+    """
+    Run extraction stages over a corpus, with a new spider (pipeline state of a previous pass is not reused).
+    Durations of stages are appended to stages, if given. Return the number of documents built.
+    """
+    import url
+    import crawler
+    from language import languages
+    from scrapy.http import HtmlResponse, Request
+
+    stages = stages if stages is not None else dict((name, []) for name in STAGES)
+    sink = MemorySink()
+    spider = crawler.SingleSpider(es_client=None, redis_conn=MemoryRedis(), sink=sink)
+    for link, html in pages :
+        t = time.time()
+        tree = url.parse(html)
+        stages["parse"].append(time.time() - t)
+        if tree is None :
+            continue
+
+        t = time.time()
+        lang = url.detect_language(tree)
+        stages["detect_language"].append(time.time() - t)
+
+        if lang in languages :
+            t = time.time()
+            body, boilerplate = url.extract_content(tree, languages[lang])
+            stages["extract_content"].append(time.time() - t)
+
+            if body :
+                t = time.time()
+                url.create_description(body)
+                stages["create_description"].append(time.time() - t)
+
+        # document build of the indexing pipeline (parse, detection, extraction and weight included)
+        response = HtmlResponse(url=link, body=html.encode("utf8"), encoding="utf8", request=Request(link))
+        t = time.time()
+        crawler.pipeline(response, spider)
+        stages["pipeline"].append(time.time() - t)
+    return sink.documents
+
+def run(pages) :
+    """
+    Run extraction stages over a corpus, return the benchmark results.
+    Stages are timed in a first pass, and peak memory is measured in a second pass
+    (tracing allocations slows down allocation-heavy stages).
+    """
+    import url
+    import schema
+    import metrics
+    import tldextract
+    from language import languages
+
+    url.tld_extract = tldextract.TLDExtract(suffix_list_urls=()) # public suffix list bundled with tldextract, no download
+    schema.known_indices.update("web-%s"%lang for lang in languages) # no index creation
+    metrics.METRICS_INTERVAL = float("inf") # pipeline metrics are sent to the stand-in, at the end
+
+    stages = dict((name, []) for name in STAGES)
+    start = time.time()
+    documents = run_pass(pages, stages)
+    elapsed = time.time() - start
+
+    tracemalloc.start()
+    run_pass(pages)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    metrics.flush(MemoryRedis())
+
+    return {
+        "pages":len(pages),
+        "documents":documents,
+        "pages_per_second":len(pages) / elapsed if elapsed else 0,
+        "stages":dict((name, summary(durations)) for name, durations in stages.items()),
+        "peak_memory_mb":peak / 1024.0 / 1024.0, # python allocations
+        "max_rss_mb":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    }
+
+def compare(results, baseline, tolerance) :
+    """
+    Compare results with a baseline, return the list of regressions.
+    """
+    regressions = []
+    if results["pages_per_second"] < baseline["pages_per_second"] * (1 - tolerance) :
+        regressions.append("pages/sec : %.1f (baseline %.1f)"%(results["pages_per_second"], baseline["pages_per_second"]))
+    for name, stage in results["stages"].items() :
+        base = baseline["stages"].get(name, {})
+        for stat in ["p50", "p95"] :
+            if stat in stage and base.get(stat) and stage[stat] > base[stat] * (1 + tolerance) :
+                regressions.append("%s %s : %.2fms (baseline %.2fms)"%(name, stat, stage[stat], base[stat]))
+    if results["peak_memory_mb"] > baseline["peak_memory_mb"] * (1 + tolerance) :
+        regressions.append("peak memory : %.1fMB (baseline %.1fMB)"%(results["peak_memory_mb"], baseline["peak_memory_mb"]))
+    return regressions
+
+def report(results) :
+    print("%s pages, %s documents, %.1f pages/sec, peak memory %.1fMB (max rss %.1fMB)"%(
+        results["pages"], results["documents"], results["pages_per_second"], results["peak_memory_mb"], results["max_rss_mb"]))
+    print("%-20s %10s %10s %10s %10s"%("stage (ms)", "mean", "p50", "p95", "p99"))
+    for name, stage in sorted(results["stages"].items()) :
+        if stage :
+            print("%-20s %10.2f %10.2f %10.2f %10.2f"%(name, stage["mean"], stage["p50"], stage["p95"], stage["p99"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmark of page extraction.")
+    parser.add_argument("--corpus", help="directory of saved pages (*.html)")
+    parser.add_argument("--pages", type=int, default=BENCHMARK_PAGES, help="number of generated pages")
+    parser.add_argument("--seed", type=int, default=0, help="seed of generated corpus")
+    parser.add_argument("--generate", help="write the generated corpus to a directory, and exit")
+    parser.add_argument("--save", help="save results as baseline (json file)")
+    parser.add_argument("--compare", help="compare results with a baseline (json file)")
+    parser.add_argument("--tolerance", type=float, default=BENCHMARK_TOLERANCE, help="tolerated slowdown (ratio)")
+    args = parser.parse_args()
+
+    pages = load(args.corpus) if args.corpus else generate(args.pages, args.seed)
+    if args.generate :
+        save(pages, args.generate)
+        print("%s pages written to %s"%(len(pages), args.generate))
+        sys.exit(0)
+
+    results = run(pages)
+    report(results)
+
+    if args.save :
+        with open(args.save, "w") as f :
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("baseline saved to %s"%args.save)
+    if args.compare :
+        with open(args.compare) as f :
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions :
+            print("regression : %s"%regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Toolbox for bulk indexing.
+Documents are buffered and sent to ElasticSearch in one bulk request,
+instead of one HTTP round-trip per document.
+In a Twisted reactor (crawls), bulk requests are sent in a thread (see ReactorBulkIndexer).
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import time
+import threading
+import cache
+import schema
+import metrics
+
+class BulkIndexer(object):
+    """
+    Buffer of documents, flushed into ElasticSearch when one of these limits is reached :
+        - max_docs : number of buffered documents
+        - max_bytes : size of the serialized bulk body
+        - interval : seconds since the last flush
+    If a redis connection is given, cached search results of written indices are invalidated after each flush
+    (and written pages are recorded for a running reindex, see reindex.py).
+    """
+    def __init__(self, client, max_docs=None, max_bytes=None, interval=None, redis_conn=None) :
+        self.client = client
+        self.redis_conn = redis_conn
+        self.max_docs = max_docs or int(os.getenv("BULK_MAX_DOCS", 500))
+        self.max_bytes = max_bytes or int(os.getenv("BULK_MAX_BYTES", 5*1024*1024))
+        self.interval = interval or float(os.getenv("BULK_INTERVAL", 5))
+        self.lines = [] # serialized action and source lines
+        self.items = [] # (index, id, callback) of each buffered document
+        self.size = 0
+        self.last_flush = time.time()
+        self.indexed = 0 # number of documents successfully indexed
+        self.failed = 0 # number of documents in error
+        self.lock = threading.Lock() # buffer and counters are shared with threads sending bulk requests
+
+    def add(self, index, doc_type, id, body, callback=None, action="index") :
+        """
+        Add a document to the buffer, and flush if a limit is reached.
+        The optional callback is called with the indexed document id, once it has been indexed.
+        With action "update", body holds the fields updated in an existing document.
+        """
+        serializer = self.client.transport.serializer
+        source = serializer.dumps(body if action == "index" else {"doc":body})
+        action = serializer.dumps({action:{"_index":index, "_type":doc_type, "_id":id}})
+        with self.lock :
+            self.lines.append(action)
+            self.lines.append(source)
+            self.items.append((index, id, callback))
+            self.size += len(action) + len(source) + 2
+            full = len(self.items) >= self.max_docs or self.size >= self.max_bytes
+        if full or self.due() :
+            return self.flush()
+
+    def due(self) :
+        """
+        True if the buffer is not empty and the flush interval is elapsed.
+        """
+        return bool(self.items) and time.time() - self.last_flush >= self.interval
+
+    def flush_if_due(self) :
+        """
+        Flush the buffer only if the flush interval is elapsed (called periodically).
+        """
+        if self.due() :
+            return self.flush()
+
+    def flush(self) :
+        """
+        Send all buffered documents in one bulk request.
+        Return the number of documents indexed.
+        """
+        return self.send(*self.take())
+
+    def take(self) :
+        """
+        Empty the buffer, return its serialized lines and items.
+        """
+        with self.lock :
+            self.last_flush = time.time()
+            lines, items = self.lines, self.items
+            self.lines, self.items, self.size = [], [], 0
+        return lines, items
+
+    def send(self, lines, items) :
+        """
+        Send documents in one bulk request, then call their callbacks.
+        Return the number of documents indexed.
+        """
+        if not items :
+            return 0
+
+        try :
+            with metrics.timer("es_write") :
+                response = self.client.bulk(body="\n".join(lines)+"\n")
+        except Exception as e :
+            # the whole request failed, all documents are in error
+            for index, id, callback in items :
+                self.failure(index, id, str(e))
+            return 0
+
+        indexed = 0
+        written = {}
+        for (index, id, callback), item in zip(items, response["items"]) :
+            result = list(item.values())[0] if item else {}
+            if "error" in result or result.get("status", 500) >= 300 :
+                self.failure(index, id, result.get("error", result.get("status")))
+                continue
+            indexed += 1
+            written.setdefault(index, []).append(id)
+            if callback :
+                try :
+                    callback(id)
+                except Exception as e :
+                    # an error after indexing never fails the other documents
+                    print("bulk callback error on %s (%s) : %s"%(id, index, e))
+        with self.lock :
+            self.indexed += indexed
+        metrics.incr("pages_indexed", indexed)
+        if self.redis_conn is not None and written :
+            try :
+                cache.invalidate(self.redis_conn, list(written))
+                schema.record_writes(self.redis_conn, written)
+            except Exception as e :
+                print("bulk invalidation error on %s : %s"%(", ".join(sorted(written)), e))
+        return indexed
+
+    def failure(self, index, id, error) :
+        """
+        Report a document that could not be indexed.
+        """
+        with self.lock :
+            self.failed += 1
+        metrics.incr("pages_failed")
+        print("bulk indexing error on %s (%s) : %s"%(id, index, error))
+
+class ReactorBulkIndexer(BulkIndexer):
+    """
+    Bulk indexer of a Twisted reactor : bulk requests and callbacks of indexed documents run in a thread
+    of the reactor pool, never blocking downloads.
+    A flush returns a Deferred, fired once its bulk request is done (never with an error).
+    """
+    def flush(self) :
+        from twisted.internet import threads
+        d = threads.deferToThread(self.send, *self.take())
+        d.addErrback(lambda failure : print("bulk indexing error : %s"%failure.getErrorMessage()))
+        return d
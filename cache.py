@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Toolbox for the cache of search results, in Redis.
+A cached result is bound to the generation of each index searched : when the indexing pipeline
+writes into an index, its generation is increased and old results of this index are never read again.
+New documents are searchable only after the next refresh of the index : results of an index written
+less than SEARCH_CACHE_SETTLE seconds ago (above the refresh interval of indices) are not cached.
+Cache size is bounded by a memory budget, least recently used results are evicted first.
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import re
+import json
+import time
+import hashlib
+
+# lifetime of a cached result (seconds) and memory budget of cache (bytes)
+CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 300))
+CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", 64*1024*1024))
+CACHE_SETTLE = float(os.getenv("SEARCH_CACHE_SETTLE", 2))
+
+# save a result and account its size (a result saved again under the same key replaces its former size)
+PUT_SCRIPT = """
+local size = string.len(ARGV[1])
+local former = tonumber(redis.call('HGET', KEYS[3], KEYS[1]) or '0')
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('HSET', KEYS[3], KEYS[1], size)
+return redis.call('INCRBY', KEYS[4], size - former)
+"""
+
+def invalidate(redis_conn, indices) :
+    """
+    Increase the generation of indices (called when documents are written into them),
+    and stop caching their results until written documents are searchable.
+    """
+    pipe = redis_conn.pipeline(transaction=False)
+    for index in set(indices) :
+        pipe.incr("search:generation:%s"%index)
+        pipe.set("search:settling:%s"%index, 1, px=int(CACHE_SETTLE * 1000))
+    pipe.execute()
+
+def key(redis_conn, indices, query, domain, start, hits) :
+    """
+    Cache key of a search : normalized query, site filter, pagination and generations of indices searched.
+    Return None if one of the indices was written recently (result not cacheable yet).
+    """
+    indices = sorted(indices)
+    values = redis_conn.mget(["search:generation:%s"%index for index in indices] + ["search:settling:%s"%index for index in indices])
+    if any(values[len(indices):]) :
+        return None
+    generations = [int(generation or 0) for generation in values[:len(indices)]]
+    query = re.sub("\\s+", " ", (query or "").strip().lower())
+    data = json.dumps([query, (domain or "").lower(), start, hits, indices, generations])
+    return "search:cache:%s"%hashlib.sha1(data.encode("utf8")).hexdigest()
+
+def get(redis_conn, key) :
+    """
+    Get a cached search result, or None.
+    """
+    if key is None :
+        return None
+    value = redis_conn.get(key)
+    pipe = redis_conn.pipeline(transaction=False)
+    if value is None :
+        pipe.hincrby("search:cache:stats", "misses")
+    else :
+        pipe.hincrby("search:cache:stats", "hits")
+        pipe.zadd("search:cache:lru", {key:time.time()})
+    pipe.execute()
+    return json.loads(value.decode("utf8")) if value is not None else None
+
+def put(redis_conn, key, result) :
+    """
+    Cache a search result, and evict least recently used results if memory budget is exceeded.
+    """
+    if key is None :
+        return
+    script = redis_conn.register_script(PUT_SCRIPT)
+    size = script(keys=[key, "search:cache:lru", "search:cache:sizes", "search:cache:bytes"],
+        args=[json.dumps(result), CACHE_TTL, time.time()])
+    if size > CACHE_MAX_BYTES :
+        evict(redis_conn, size - CACHE_MAX_BYTES)
+
+def evict(redis_conn, excess) :
+    """
+    Evict least recently used results (expired ones first), until excess bytes are freed.
+    """
+    while excess > 0 :
+        keys = [key for key, score in redis_conn.zpopmin("search:cache:lru", 100)]
+        if not keys :
+            break
+        sizes = [int(size or 0) for size in redis_conn.hmget("search:cache:sizes", keys)]
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.delete(*keys)
+        pipe.hdel("search:cache:sizes", *keys)
+        pipe.decrby("search:cache:bytes", sum(sizes))
+        pipe.hincrby("search:cache:stats", "evictions", len(keys))
+        pipe.execute()
+        excess -= sum(sizes)
+
+def stats(redis_conn) :
+    """
+    Hits, misses, evictions, hit rate and size (bytes) of cache.
+    """
+    counts = dict((name, 0) for name in ["hits", "misses", "evictions"])
+    counts.update((name.decode("utf8"), int(count)) for name, count in redis_conn.hgetall("search:cache:stats").items())
+    total = counts["hits"] + counts["misses"]
+    counts["hit_rate"] = float(counts["hits"]) / total if total else 0.0
+    counts["bytes"] = int(redis_conn.get("search:cache:bytes") or 0)
+    return counts
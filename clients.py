@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Toolbox for connections to ElasticSearch and Redis.
+Connections are shared by the whole process, pooled, and created lazily at first use :
+importing a module (API, worker, job) does no network round-trip.
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+from redis import Redis, ConnectionPool
+from elasticsearch_dsl.connections import connections
+
+# size of connection pools and timeout of elasticsearch requests (seconds)
+ES_MAXSIZE = int(os.getenv("ES_MAXSIZE", 25))
+ES_TIMEOUT = float(os.getenv("ES_TIMEOUT", 30))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+
+class Lazy(object):
+    """
+    Proxy of an object created at first use.
+    """
+    def __init__(self, factory) :
+        self._factory = factory
+        self._instance = None
+
+    def __getattr__(self, name) :
+        if self._instance is None :
+            self._instance = self._factory()
+        return getattr(self._instance, name)
+
+def create_elastic() :
+    """
+    Create the elasticsearch connection (default connection of elasticsearch_dsl).
+    """
+    hosts = [os.getenv("HOST")]
+    http_auth = (os.getenv("USERNAME"), os.getenv("PASSWORD"))
+    port = os.getenv("PORT")
+    return connections.create_connection(hosts=hosts, http_auth=http_auth, port=port, maxsize=ES_MAXSIZE, timeout=ES_TIMEOUT)
+
+# elasticsearch client, connected at first request
+elastic = Lazy(create_elastic)
+
+# redis client (redis-py connects at first command)
+redis_conn = Redis(connection_pool=ConnectionPool(host=os.getenv("REDIS_HOST", "redis"), port=int(os.getenv("REDIS_PORT", 6379)), max_connections=REDIS_MAX_CONNECTIONS))
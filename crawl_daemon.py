@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Crawl daemon - a long-lived crawl service.
+One Twisted reactor runs for the whole life of the process, and index/explore work is pulled from Redis.
+Pages to index are fetched by one long-lived spider (see crawler.QueueSpider), up to CRAWL_CONCURRENCY
+requests at once. Explorations run one spider per website, up to CRAWL_CONCURRENCY crawls at once.
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import json
+import url
+import crawler
+import scheduler
+import metrics
+from bulk import ReactorBulkIndexer
+from datetime import datetime
+from twisted.internet import defer, threads
+from scrapy.crawler import CrawlerRunner
+
+# redis lists of crawl work, per type
+QUEUES = {"index":"crawl:queue:index", "explore":"crawl:queue:explore"}
+
+def submit(redis_conn, type_, link, batch=None, pipeline=None) :
+    """
+    Submit a crawl work ("index" or "explore" an url) to the daemon.
+    """
+    (pipeline or redis_conn).lpush(QUEUES[type_], json.dumps({"type":type_, "url":link, "batch":batch}))
+
+def queue_length(redis_conn) :
+    """
+    Number of crawl works waiting.
+    """
+    return sum(redis_conn.llen(queue) for queue in QUEUES.values())
+
+class CrawlDaemon(object):
+    """
+    Pull crawl work from Redis, in a single reactor : pages to index by one long-lived spider,
+    and websites to explore by one spider per website.
+    """
+    def __init__(self, redis_conn, es_client, concurrency) :
+        self.redis_conn = redis_conn
+        self.es_client = es_client
+        self.slots = defer.DeferredSemaphore(concurrency)
+        self.sink = ReactorBulkIndexer(es_client, redis_conn=redis_conn) # shared by single pages
+        self.single_runner = CrawlerRunner(dict(crawler.SINGLE_SETTINGS, CONCURRENT_REQUESTS=concurrency))
+        self.explore_runner = CrawlerRunner(crawler.EXPLORE_SETTINGS)
+        self.index_spider = None
+        self.running = True
+
+    def index(self) :
+        """
+        Start the long-lived spider indexing single pages.
+        """
+        runner_crawler = self.single_runner.create_crawler(crawler.QueueSpider)
+        d = self.single_runner.crawl(runner_crawler, queue=QUEUES["index"], es_client=self.es_client, redis_conn=self.redis_conn, sink=self.sink)
+        self.index_spider = runner_crawler.spider
+        return d
+
+    def poll(self) :
+        """
+        Wait for a free slot, then for an exploration work, and start it.
+        """
+        @defer.inlineCallbacks
+        def loop() :
+            while self.running :
+                yield self.slots.acquire()
+                # blocking pop in a thread, with timeout to check for shutdown
+                item = yield threads.deferToThread(self.redis_conn.brpop, QUEUES["explore"], 1)
+                if not item :
+                    self.slots.release()
+                    continue
+                try :
+                    work = json.loads(item[1].decode("utf8"))
+                    d = self.start(work)
+                except Exception as e :
+                    print("invalid crawl work %s : %s"%(item[1], e))
+                    self.slots.release()
+                    continue
+                d.addErrback(self.failure, work)
+                d.addBoth(lambda _ : self.slots.release())
+        return loop()
+
+    def start(self, work) :
+        """
+        Start the spider of a crawl work, return a deferred fired when crawl is done.
+        """
+        link = work["url"]
+        if work["type"] == "explore" :
+            print("explore website at : %s"%link)
+            # create or update domain data
+            domain = url.site(link)
+            self.es_client.index(index="web", doc_type='domain', id=domain, body={
+                "homepage":link,
+                "domain":domain,
+                "last_crawl":datetime.now()
+            })
+            scheduler.add_domain(self.redis_conn, domain, link)
+            # allow the whole registered domain, redirections are followed by spider (www, https,...)
+            return self.explore_runner.crawl(crawler.Crawler, allowed_domains=[domain], start_urls=[link,], es_client=self.es_client, redis_conn=self.redis_conn)
+        raise ValueError("unknown crawl work type")
+
+    def failure(self, failure, work) :
+        """
+        Report a crawl in error.
+        """
+        print("crawl error on %s : %s"%(work["url"], failure.getErrorMessage()))
+        if work.get("batch") :
+            self.redis_conn.hincrby("batch:%s"%work["batch"], "failed")
+
+    def stop(self) :
+        """
+        Stop pulling work and flush the shared bulk indexer.
+        """
+        self.running = False
+        if self.index_spider is not None :
+            self.index_spider.running = False
+        return self.sink.flush()
+
+if __name__ == '__main__':
+    # reactor of crawl settings, installed before any use of the reactor
+    from scrapy.utils.reactor import install_reactor
+    install_reactor(crawler.REACTOR)
+    from twisted.internet import reactor, task
+    from scrapy.utils.log import configure_logging
+    import clients
+
+    configure_logging()
+    redis_conn = clients.redis_conn
+    daemon = CrawlDaemon(redis_conn, clients.elastic, int(os.getenv("CRAWL_CONCURRENCY", 64)))
+
+    # flush periodically the shared bulk indexer, and on shutdown
+    task.LoopingCall(daemon.sink.flush_if_due).start(daemon.sink.interval, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', daemon.stop)
+    reactor.suggestThreadPoolSize(int(os.getenv("CRAWL_THREADS", 20)))
+
+    # analysis pool shared by all crawls of daemon, stopped on shutdown
+    crawler.pool_shared = True
+    reactor.addSystemEventTrigger('after', 'shutdown', crawler.shutdown_pool)
+
+    # serve metrics on METRICS_PORT, if any, and send buffered metrics on shutdown
+    if os.getenv("METRICS_PORT") :
+        metrics.serve(int(os.getenv("METRICS_PORT")), redis_conn)
+    reactor.addSystemEventTrigger('after', 'shutdown', metrics.flush)
+
+    reactor.callWhenRunning(daemon.index)
+    reactor.callWhenRunning(daemon.poll)
+    reactor.run()
@@ -1,45 +1,220 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import requests
 import os
 import url
 import scrapy
 import base64
 import io
-from scrapy.spiders import CrawlSpider, Rule
+import hashlib
+import time
+import json
+import signal
+import multiprocessing
+from scrapy.spiders import Rule
 from scrapy.linkextractors import LinkExtractor
-from scrapy.http import Request
+from scrapy.link import Link
+from scrapy.http import Request, HtmlResponse, Headers
+from scrapy.responsetypes import responsetypes
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import task, defer, threads
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urljoin
+from bulk import ReactorBulkIndexer
+import cache
+import freshness
+import scheduler
+import schema
+import language
 from language import languages
-from collections import Counter
 from PIL import Image
-from rq.decorators import job
-from rq import Queue
-from elasticsearch_dsl.connections import connections
+from rq import Queue, get_current_connection
+import clients
+import metrics
 
-hosts = [os.getenv("HOST")]
-http_auth = (os.getenv("USERNAME"), os.getenv("PASSWORD"))
-port = os.getenv("PORT")
-client = connections.create_connection(hosts=hosts, http_auth=http_auth, port=port)
+# elasticsearch connection (shared, created at first use)
+client = clients.elastic
 
-class SingleSpider(scrapy.spiders.CrawlSpider):
+# settings of thumbnails : size, jpeg quality, maximum size of image (bytes), download timeout (seconds)
+# and lifetime of computed thumbnails (seconds)
+THUMBNAIL_SIZE = 143, 143
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 70))
+THUMBNAIL_MAX_BYTES = int(os.getenv("THUMBNAIL_MAX_BYTES", 2*1024*1024))
+THUMBNAIL_TIMEOUT = float(os.getenv("THUMBNAIL_TIMEOUT", 10))
+THUMBNAIL_TTL = int(os.getenv("THUMBNAIL_TTL", 30*24*3600))
+THUMBNAIL_RETRY_TTL = int(os.getenv("THUMBNAIL_RETRY_TTL", 3600)) # download failed, tried again after
+
+# number of terms of a page suggested by query autocomplete
+SUGGEST_TERMS = int(os.getenv("SUGGEST_TERMS", 10))
+
+# number of processes analyzing pages during crawls, and maximum of pages sent to them at once
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", os.cpu_count() or 1))
+ANALYSIS_QUEUE = int(os.getenv("ANALYSIS_QUEUE", ANALYSIS_WORKERS * 4))
+
+# settings of crawls (the reactor is set explicitly, the crawl daemon installs it before starting)
+REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.75 Safari/537.36"
+SINGLE_SETTINGS = {
+    'TWISTED_REACTOR':REACTOR,
+    'TELNETCONSOLE_ENABLED':False,
+    'USER_AGENT': USER_AGENT,
+    'DOWNLOAD_TIMEOUT':url.FETCH_TIMEOUT,
+    'DOWNLOAD_MAXSIZE':url.FETCH_MAX_BYTES,
+    'REDIRECT_ENABLED':False,
+    'SPIDER_MIDDLEWARES' : {
+        'scrapy.spidermiddlewares.httperror.HttpErrorMiddleware':True
+    },
+    'DOWNLOADER_MIDDLEWARES' : {
+        'crawler.ConditionalRequestMiddleware':560
+    },
+    'ITEM_PIPELINES' : {
+        'crawler.AnalysisPipeline':300
+    }
+}
+EXPLORE_SETTINGS = {
+    'TWISTED_REACTOR':REACTOR,
+    'TELNETCONSOLE_ENABLED':False,
+    'USER_AGENT': USER_AGENT,
+    'DOWNLOAD_TIMEOUT':url.FETCH_TIMEOUT,
+    'DOWNLOAD_MAXSIZE':url.FETCH_MAX_BYTES,
+    'DOWNLOAD_DELAY':0, # politeness is done by the shared frontier (see frontier.py)
+    'SCHEDULER':'frontier.Scheduler',
+    'ROBOTSTXT_OBEY':True,
+    'HTTPCACHE_ENABLED':False,
+    'REDIRECT_ENABLED':False,
+    'SPIDER_MIDDLEWARES' : {
+        'scrapy.downloadermiddlewares.robotstxt.RobotsTxtMiddleware':True,
+        'scrapy.spidermiddlewares.httperror.HttpErrorMiddleware':True,
+        'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware':True,
+        'scrapy.extensions.closespider.CloseSpider':True
+    },
+    'DOWNLOADER_MIDDLEWARES' : {
+        'crawler.ConditionalRequestMiddleware':560
+    },
+    'ITEM_PIPELINES' : {
+        'crawler.AnalysisPipeline':300
+    },
+    'CLOSESPIDER_PAGECOUNT':500 #only for debug
+}
+
+class ConditionalRequestMiddleware(object):
+    """
+    Downloader middleware sending conditional requests (If-None-Match, If-Modified-Since) on pages already indexed.
+    """
+    def process_request(self, request, spider):
+        if getattr(spider, "redis_conn", None) is None or request.method != "GET" :
+            return None
+        for name, value in freshness.conditional_headers(spider.redis_conn, request.url).items() :
+            request.headers.setdefault(name, value)
+        return None
+
+class BulkSpider(object):
+    """
+    Spider that indexes its pages through a bulk indexer (spider.sink).
+    A spider creates its own sink, unless a shared one is given, and flushes it periodically and on close.
+    """
+    sink=None # bulk indexer
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(BulkSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.open_sink, signal=signals.spider_opened)
+        crawler.signals.connect(spider.close_sink, signal=signals.spider_closed)
+        return spider
+
+    def open_sink(self, spider):
+        self.own_sink = self.sink is None
+        if not self.own_sink : # shared sink, flushed by its owner
+            return
+        self.sink = ReactorBulkIndexer(self.es_client, redis_conn=self.redis_conn)
+        self.flush_loop = task.LoopingCall(self.sink.flush_if_due)
+        self.flush_loop.start(self.sink.interval, now=False)
+
+    def close_sink(self, spider, reason):
+        if not self.own_sink :
+            return
+        if self.flush_loop.running :
+            self.flush_loop.stop()
+        return self.sink.flush()
+
+class SingleSpider(BulkSpider, scrapy.spiders.CrawlSpider):
     """
     Single page spider.
     """
     name = "spider"
-    handle_httpstatus_list = [301, 302, 303] # redirection allowed
+    handle_httpstatus_list = [301, 302, 303, 304] # redirection and not modified allowed
     es_client=None # elastic client
     redis_conn=None # redis client
 
-    def parse(self, response):
+    def parse_start_url(self, response):
         yield pipeline(response, self)
 
-class Crawler(scrapy.spiders.CrawlSpider):
+    def parse_redirect(self, response):
+        """
+        Index the target of a redirection.
+        """
+        return self.parse_start_url(response)
+
+class QueueSpider(SingleSpider):
+    """
+    Long-lived single page spider (crawl daemon) : urls to index are pulled from a Redis list (queue),
+    only when Scrapy has room for more requests, and the spider stays open while the list is empty.
+    Works are JSON objects {"url", "batch"}, batch progress is counted per page.
+    """
+    name = "queue"
+    queue = None # redis list of works
+    running = True
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(QueueSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.idle, signal=signals.spider_idle)
+        return spider
+
+    def idle(self, spider):
+        if self.running :
+            raise DontCloseSpider
+
+    async def start(self):
+        while self.running :
+            # blocking pop in a thread, with timeout to check for shutdown
+            item = await maybe_deferred_to_future(threads.deferToThread(self.redis_conn.brpop, self.queue, 1))
+            if not item :
+                continue
+            try :
+                work = json.loads(item[1].decode("utf8"))
+                request = Request(work["url"], dont_filter=True, errback=self.failure, meta={"batch":work.get("batch")})
+            except Exception as e :
+                print("invalid crawl work %s : %s"%(item[1], e))
+                continue
+            print("index page : %s"%work["url"])
+            yield request
+
+    def parse_start_url(self, response):
+        result = pipeline(response, self)
+        if isinstance(result, Request) : # a redirection is followed first
+            result = result.replace(errback=self.failure)
+        else :
+            self.progress(response.meta, "done")
+        yield result
+
+    def failure(self, failure):
+        print("crawl error on %s : %s"%(failure.request.url, failure.getErrorMessage()))
+        self.progress(failure.request.meta, "failed")
+
+    def progress(self, meta, state) :
+        if meta.get("batch") :
+            threads.deferToThread(self.redis_conn.hincrby, "batch:%s"%meta["batch"], state)
+
+class Crawler(BulkSpider, scrapy.spiders.CrawlSpider):
     """
     Explore a website and index all urls.
     """
     name = 'crawler'
-    handle_httpstatus_list = [301, 302, 303] # redirection allowed
+    handle_httpstatus_list = [301, 302, 303, 304] # redirection and not modified allowed
     rules = (
         # Extract all inner domain links with state "follow"
         Rule(LinkExtractor(), callback='parse_items', follow=True, process_links='links_processor'),
@@ -58,96 +233,353 @@ class Crawler(scrapy.spiders.CrawlSpider):
                     ret_links.append(link)
         return ret_links
 
+    async def start(self):
+        """
+        Start requests are flagged, the flag is kept along their redirections (see pipeline).
+        """
+        for link in self.start_urls :
+            yield Request(link, dont_filter=True, meta={"start_request":True})
+
+    def parse_start_url(self, response):
+        """
+        Index the start page and save the final homepage of website (after redirections).
+        """
+        if response.meta.get("start_request") and 200 <= response.status < 300 :
+            self.es_client.update(index="web", doc_type='domain', id=url.site(response.url), body={"doc":{"homepage":response.url}})
+        yield from self.follow_saved_links(response)
+        yield pipeline(response, self)
+
     def parse_items(self, response):
         """
         Parse and analyze one url of website.
         """
+        yield from self.follow_saved_links(response)
         yield pipeline(response, self)
 
+    def parse_redirect(self, response):
+        """
+        Parse the target of a redirection as any page of website (links followed by rules),
+        or as the start page if the start url was redirected.
+        """
+        callback = self.parse_start_url if response.meta.get("start_request") else self.parse_items
+        return self.parse_with_rules(response, callback, {}, follow=True)
+
+    def follow_saved_links(self, response):
+        """
+        A page not modified (304) has no body : follow the links saved when it was indexed.
+        """
+        if response.status == 304 :
+            for link in freshness.links(self.redis_conn, response.url) :
+                yield self._build_request(0, Link(link))
+
+def response_from_fetch(r) :
+    """
+    Build a Scrapy response from a fetched page (see url.fetch), to feed the pipeline.
+    """
+    headers = dict(r.headers)
+    cls = responsetypes.from_args(headers=Headers(headers), url=r.url, body=r.content)
+    return cls(url=r.url, status=r.status_code, headers=headers, body=r.content, request=Request(r.url))
+
 def pipeline(response, spider) :
     """
-    Index a page.
+    Index a page : checks of response, analysis of page (CPU heavy), then indexing.
+    In a crawl, the page is returned as an item and analyzed in a pool of processes (see AnalysisPipeline).
     """
-    # skip rss or atom urls
-    if not response.css("html").extract_first() :
+    # check for redirect url
+    if response.status in spider.handle_httpstatus_list and 'Location' in response.headers:
+        newurl = response.headers['Location']
+        meta = {'dont_redirect': True, "handle_httpstatus_list" : spider.handle_httpstatus_list}
+        meta.update(response.request.meta)
+        return Request(url = response.urljoin(newurl.decode("utf8")), meta = meta, callback=spider.parse_redirect)
+
+    # page not modified since last indexing
+    if response.status == 304 :
+        freshness.count(spider.redis_conn, "not_modified")
+        scheduler.observe(spider.redis_conn, response.url, changed=False)
+        return
+
+    # skip rss, atom or binary urls
+    if not isinstance(response, HtmlResponse) :
+        metrics.incr("pages_skipped")
         return
 
-    # get domain
-    domain = url.domain(response.url)
+    # download time of page (crawled pages, fetched pages are timed by their job)
+    if "download_latency" in response.meta :
+        metrics.observe("fetch", response.meta["download_latency"])
 
-    # extract title
-    title = response.css('title::text').extract_first()
-    title = title.strip() if title else ""
+    if getattr(spider, "analysis", None) is not None :
+        return {"response":response}
+    index_page(response, spider, analyze(*analysis_args(response, spider)))
 
-    # extract description
-    description = response.css("meta[name=description]::attr(content)").extract_first()
-    description = description.strip() if description else ""
+def analysis_args(response, spider) :
+    """
+    Arguments of the analysis of a page (see analyze) : page data and data read from Redis.
+    """
+    domain = url.site(response.url)
+    return (response.url, domain, response.text, freshness.header(response.headers, "Content-Language"),
+        freshness.saved_hash(spider.redis_conn, response.url), language.domain_language(domain, spider.redis_conn))
+
+@contextmanager
+def timed(timings, stage) :
+    """
+    Time a stage of analysis (timings are sent to metrics by the indexing process).
+    """
+    start = time.time()
+    try :
+        yield
+    finally :
+        timings[stage] = time.time() - start
+
+def analyze(link, domain, html, content_language, saved_hash, domain_lang) :
+    """
+    Analyze a page : extraction of metadata, language and main content, weight of page.
+    Pure function (no Redis or ElasticSearch), run in a pool of processes during crawls.
+    Return the status of page ("invalid", "unchanged", "unsupported" language or "new" content),
+    and its analysis.
+    """
+    timings = {}
+    analysis = {"timings":timings}
+
+    # parse page once, for all extraction steps
+    with timed(timings, "parse") :
+        tree = url.parse(html)
+    if tree is None :
+        analysis["status"] = "invalid"
+        return analysis
+
+    # extract title, description and image
+    metadata = url.extract_metadata(tree)
+    title = metadata["title"]
+    description = metadata["description"]
+
+    # skip page if its content did not change since last indexing (validators may have changed)
+    analysis["digest"] = digest = freshness.content_hash(tree, metadata)
+    if digest == saved_hash :
+        analysis["status"] = "unchanged"
+        return analysis
 
     # get main language of page, and main content of page
-    lang = url.detect_language(response.body)
-    if lang not in languages :
-        raise InvalidUsage('Language not supported')
-    body, boilerplate = url.extract_content(response.body, languages.get(lang))
+    with timed(timings, "language") :
+        analysis["tier"], analysis["lang"] = tier, lang = language.detect_tier(tree, domain_lang, headers={"Content-Language":content_language})
+    if lang not in languages : # language not supported
+        analysis["status"] = "unsupported"
+        return analysis
+    with timed(timings, "extract") :
+        body, boilerplate = url.extract_content(tree, languages.get(lang))
 
     # weight of page
-    weight = 3
-    if not title and not description :
-        weight = 0
-    elif not title :
-        weight = 1
-    elif not description :
-        weight = 2
-    if body.count(" ") < boilerplate.count(" ") or not url.create_description(body) :
-        # probably bad content quality
-        weight -= 1
-
-    # -- TEST -- #
-    """keywords = Counter()
-    text_for_keywords = "%s\n%s\n%s"%(title, description, bestbody)
-    r = requests.post('http://localhost:5001/keywords_from_text', data = {'text':text_for_keywords})
-    data = r.json()
-    #print(hit.url, data)
-    for k in data["keywords"] :
-        keywords[k] += 1
-    keywords = " ".join(["%s "%(kw)*score for kw, score in keywords.most_common(100)])"""
-
-    # index url and data
-    res = spider.es_client.index(index="web-%s"%lang, doc_type='page', id=response.url, body={
-        "url":response.url,
-        "domain":domain,
-        "title":title,
-        "description":description,
-        "body":body,
-        "weight":weight
+    with timed(timings, "weight") :
+        weight = 3
+        if not title and not description :
+            weight = 0
+        elif not title :
+            weight = 1
+        elif not description :
+            weight = 2
+        created_description = url.create_description(body)
+        if body.count(" ") < boilerplate.count(" ") or not created_description :
+            # probably bad content quality
+            weight -= 1
+
+    # snippet of result, for pages without description
+    snippet = url.create_snippet(created_description) if not description else ""
+
+    # suggestions of query autocomplete : title and most frequent terms of page, better pages first
+    suggest = {
+        "input":([title] if title else []) + url.extract_terms(body, languages[lang], SUGGEST_TERMS),
+        "weight":max(weight, 0) + 1
+    }
+
+    analysis.update({
+        "status":"new",
+        "image":urljoin(link, metadata["image"]) if metadata["image"] else None,
+        "links":url.extract_links(tree, link),
+        "document":{
+            "url":link,
+            "domain":domain,
+            "title":title,
+            "description":description,
+            "body":body,
+            "snippet":snippet,
+            "suggest":suggest,
+            "weight":weight
+        }
     })
+    return analysis
 
-    # try to create thumbnail from page
-    img_link = response.css("meta[property='og:image']::attr(content)").extract_first()
-    if not img_link :
-        img_link = response.css("meta[name='twitter:image']::attr(content)").extract_first()
-    if img_link :
-        q = Queue(connection=spider.redis_conn)
-        q.enqueue(create_thumbnail, response.url, lang, img_link)
+def index_page(response, spider, analysis) :
+    """
+    Index an analyzed page (see analyze) and save its data in Redis.
+    """
+    for stage, seconds in analysis["timings"].items() :
+        metrics.observe(stage, seconds)
+    if "tier" in analysis :
+        language.count(spider.redis_conn, url.domain(response.url), analysis["tier"], analysis["lang"])
 
-    # check for redirect url
-    if response.status in spider.handle_httpstatus_list and 'Location' in response.headers:
-        newurl = response.headers['Location']
-        meta = {'dont_redirect': True, "handle_httpstatus_list" : spider.handle_httpstatus_list}
-        meta.update(response.request.meta)
-        return Request(url = newurl.decode("utf8"), meta = meta, callback=spider.parse)
+    status = analysis["status"]
+    if status == "invalid" :
+        return
+    if status == "unchanged" :
+        freshness.count(spider.redis_conn, "unchanged")
+        freshness.save(spider.redis_conn, response.url, response.headers, analysis["digest"])
+        scheduler.observe(spider.redis_conn, response.url, changed=False)
+        return
+    if status == "unsupported" :
+        metrics.incr("pages_unsupported_language")
+        return
+
+    # once the page is indexed, save its freshness data and try to create thumbnail from page
+    lang = analysis["lang"]
+    def callback(url_id) :
+        freshness.save(spider.redis_conn, url_id, response.headers, analysis["digest"], analysis["links"])
+        freshness.count(spider.redis_conn, "changed")
+        scheduler.observe(spider.redis_conn, url_id, changed=True)
+        if analysis["image"] :
+            q = Queue(connection=spider.redis_conn)
+            q.enqueue(create_thumbnail, url_id, lang, analysis["image"])
 
+    # index url and data (buffered, sent in bulk), into index of language (created if needed)
+    index = schema.ensure_index(spider.es_client, spider.redis_conn, lang)
+    spider.sink.add(index=index, doc_type='page', id=response.url, body=analysis["document"], callback=callback)
+
+# pool of processes analyzing pages, and bound of pages in analysis (created at first crawled page)
+pool = None
+pool_slots = None
+pool_shared = False # True in a long-lived process (crawl daemon) : pool kept between crawls, shut down on exit
+
+def init_analysis_worker() :
+    """
+    Initialize a process of analysis pool : interruptions are handled by the crawling process,
+    and stop words of all languages are read at once.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for lang in languages.values() :
+        try :
+            url.get_stoplist(lang)
+        except ValueError : # no stop words for this language
+            pass
+
+def analysis_pool() :
+    """
+    Pool of processes analyzing pages (shared by all crawls of process), and bound of pages in analysis.
+    Processes are started by a fork server, never forked from the crawling process (its reactor threads,
+    locks and connections are not copied in a half-used state).
+    """
+    global pool, pool_slots
+    if pool is None :
+        pool = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS, mp_context=multiprocessing.get_context("forkserver"),
+            initializer=init_analysis_worker)
+        pool_slots = defer.DeferredSemaphore(ANALYSIS_QUEUE)
+    return pool, pool_slots
+
+def shutdown_pool() :
+    """
+    Stop the processes of analysis pool, if any.
+    """
+    global pool, pool_slots
+    if pool is not None :
+        pool.shutdown(wait=True)
+        pool, pool_slots = None, None
+
+class AnalysisPipeline(object):
+    """
+    Item pipeline analyzing pages in a pool of processes, out of the reactor thread
+    (data of page read from Redis in a thread).
+    While pages wait for their analysis, Scrapy stops taking requests from its scheduler
+    (pending items are part of the scraper memory, see SCRAPER_SLOT_MAX_ACTIVE_SIZE),
+    and at most ANALYSIS_QUEUE pages are sent to the pool at once.
+    """
+    def open_spider(self, spider) :
+        spider.analysis = self
+
+    def close_spider(self, spider) :
+        if not pool_shared :
+            shutdown_pool()
+
+    def process_item(self, item, spider) :
+        response = item["response"]
+        pool, slots = analysis_pool()
+        d = threads.deferToThread(analysis_args, response, spider) # blocking reads of Redis
+        d.addCallback(lambda args : slots.run(self.submit, pool, args))
+        d.addCallback(lambda analysis : index_page(response, spider, analysis))
+        d.addCallback(lambda _ : {"url":response.url})
+        return d
+
+    def submit(self, pool, args) :
+        """
+        Analyze a page in pool, return a deferred fired with its analysis.
+        """
+        from twisted.internet import reactor
+        d = defer.Deferred()
+        def done(future) :
+            if future.exception() is not None :
+                reactor.callFromThread(d.errback, future.exception())
+            else :
+                reactor.callFromThread(d.callback, future.result())
+        pool.submit(analyze, *args).add_done_callback(done)
+        return d
 
 def create_thumbnail(url_id, lang, link) :
     """
     Create a thumbnail from image link.
+    Images are downloaded once per link (and thumbnails computed once per image content),
+    then the thumbnail is added to page with a partial update.
     """
     print("create thumbnail of : %s"%link)
+    with metrics.timer("thumbnail") :
+        done = update_thumbnail(url_id, lang, link)
+    metrics.flush() # end of job
+    return done
+
+def update_thumbnail(url_id, lang, link) :
+    """
+    Add the thumbnail of an image link to page, return 1 if done.
+    """
+    redis_conn = get_current_connection()
 
-    size = 143, 143
-    r = requests.get(link, stream=True) # get image data
-    if r.status_code == 200:
+    # thumbnail already computed for this link ?
+    link_key = "thumbnail:link:%s"%hashlib.sha1(link.encode("utf8")).hexdigest()
+    img_hash = redis_conn.get(link_key)
+    if img_hash is None :
+        img_hash = download_thumbnail(link, redis_conn)
+        if img_hash is None : # download failed (maybe temporarily), not tried again before a while
+            redis_conn.set(link_key, "", ex=THUMBNAIL_RETRY_TTL)
+            return 0
+        redis_conn.set(link_key, img_hash, ex=THUMBNAIL_TTL)
+    elif not isinstance(img_hash, str) :
+        img_hash = img_hash.decode("utf8")
+    if not img_hash : # no valid image, or download failed recently
+        return 0
+    img_str = redis_conn.get("thumbnail:data:%s"%img_hash)
+    if img_str is None : # expired
+        redis_conn.delete(link_key)
+        return 0
+
+    # finally, save into elasticsearch (partial update, page is not read back)
+    client.update(index="web-%s"%lang, doc_type='page', id=url_id, body={"doc":{"thumbnail":img_str.decode("utf8")}})
+    cache.invalidate(redis_conn, ["web-%s"%lang])
+    schema.record_writes(redis_conn, {"web-%s"%lang:[url_id]})
+    return 1
+
+def download_thumbnail(link, redis_conn) :
+    """
+    Download an image (bounded in size and time) and save its thumbnail, once per image content.
+    Return the hash of image content, an empty string if image is not valid (too large or not decodable),
+    or None if download failed.
+    """
+    r = url.fetch(link, headers={"User-Agent":USER_AGENT}, timeout=THUMBNAIL_TIMEOUT, max_bytes=THUMBNAIL_MAX_BYTES)
+    if r is None or r.status_code != 200 or not r.content :
+        return None
+    if r.truncated :
+        return ""
+    img_hash = hashlib.sha1(r.content).hexdigest()
+    data_key = "thumbnail:data:%s"%img_hash
+    if redis_conn.exists(data_key) : # same image already seen on another link
+        return img_hash
+
+    try :
         img = Image.open(io.BytesIO(r.content))
-        format_ = img.format # format of image (mime type: jpg, png,...)
+        img.draft("RGB", THUMBNAIL_SIZE) # fast decoding at reduced size (jpeg)
         longer_side = max(img.size)
         horizontal_padding = (longer_side - img.size[0]) / 2
         vertical_padding = (longer_side - img.size[1]) / 2
@@ -160,17 +592,22 @@ def create_thumbnail(url_id, lang, link) :
                 img.size[1] + vertical_padding
             )
         )
-        img.thumbnail(size) # create thumbnail
-        # encode in base64
+        img.thumbnail(THUMBNAIL_SIZE) # create thumbnail
+        # compact format : jpeg, transparency on white background
+        if img.mode in ("RGBA", "LA", "P") :
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != "RGB" :
+            img = img.convert("RGB")
         buffer_ = io.BytesIO()
-        img.save(buffer_, format=format_)
-        img_str = b"data:image/%s;base64,%s"%(format_.lower().encode("utf8"),base64.b64encode(buffer_.getvalue()))
-        img_str = img_str.decode("utf8")
-
-        # finally, save into elasticsearch
-        url = client.get(index="web-%s"%lang, doc_type='page', id=url_id)
-        url["_source"]["thumbnail"] = img_str
-        res = client.index(index="web-%s"%lang, doc_type='page', id=url_id, body=url["_source"])
-        return 1
+        img.save(buffer_, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    except Exception as e :
+        print("invalid image %s : %s"%(link, e))
+        return ""
 
-    return 0
+    # encode in base64
+    img_str = b"data:image/jpeg;base64,%s"%base64.b64encode(buffer_.getvalue())
+    redis_conn.set(data_key, img_str, ex=THUMBNAIL_TTL)
+    return img_hash
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Toolbox for searching : analysis of a search request, elasticsearch query and results.
+Shared by the API (index.py) and the asynchronous API (async_api.py).
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import re
+import query
+import language
+from language import languages
+
+# aliases of all languages (versioned indices are never searched directly, a reindex would duplicate results)
+ALL_INDICES = ",".join("web-%s"%lang for lang in sorted(languages))
+
+def plan(data) :
+    """
+    Analyze the data of a search request (query, start, hits, lang).
+    Return the search plan, or raise a ValueError on invalid request.
+    """
+    if "query" not in data :
+        raise ValueError('No query specified in POST data')
+    try :
+        start = int(data.get("start", "0"))
+        hits = int(data.get("hits", "10"))
+    except ValueError :
+        raise ValueError('Start or hits must be integers')
+    if start < 0 or hits < 0 :
+        raise ValueError('Start or hits cannot be negative numbers')
+
+    # analyze user query
+    groups = re.search("(site:(?P<domain>[^ ]+))?( ?(?P<query>.*))?",data["query"]).groupdict()
+    if not groups.get("query", False) and not groups.get("domain", False) :
+        raise ValueError('Empty query')
+
+    # target indices : languages given, or language detected in query (all languages if unsure)
+    langs = [lang.strip() for lang in (data.get("lang") or "").split(",") if lang.strip()]
+    for lang in langs :
+        if lang not in languages :
+            raise ValueError('Language not supported : %s'%lang)
+    detected = False
+    if not langs and groups.get("query", False) :
+        lang = language.detect_query(groups["query"])
+        if lang :
+            langs, detected = [lang], True
+
+    return {
+        "query":groups["query"],
+        "domain":groups["domain"],
+        "start":start,
+        "hits":hits,
+        "detected":detected, # language detected, not given
+        "indices":["web-%s"%lang for lang in (langs or sorted(languages))],
+        "index":",".join("web-%s"%lang for lang in langs) if langs else ALL_INDICES
+    }
+
+def cache_indices(plan) :
+    """
+    Indices whose changes invalidate the results of a search plan (see cache.py) : the indices searched,
+    or all indices if the language was detected (no result in detected language : all languages are searched).
+    """
+    return ALL_INDICES.split(",") if plan["detected"] else plan["indices"]
+
+def body(plan, builders=query) :
+    """
+    Elasticsearch query of a search plan.
+    builders is the module of query builders (see query.py), another one can be given to compare variants.
+    """
+    if plan["query"] and plan["domain"] :
+        # expression in domain query
+        return builders.domain_expression_query(plan["domain"], plan["query"])
+    elif plan["domain"] :
+        # domain query
+        return builders.domain_query(plan["domain"])
+    # expression query
+    return builders.expression_query(plan["query"])
+
+def results(plan, response) :
+    """
+    Total and formatted results of an elasticsearch response.
+    Hits collapsed on domain are replaced by the best pages of their domain (inner hits).
+    """
+    hits = []
+    for hit in response["hits"]["hits"] :
+        inner_hits = hit.get("inner_hits", {}).get("domain")
+        hits.extend(inner_hits["hits"]["hits"] if inner_hits else [hit])
+    results = [format_result(hit["_source"], hit.get("highlight", None)) for hit in hits]
+    if plan["query"] and not plan["domain"] :
+        # expression query : total of domains
+        total = response["aggregations"]["domains"]["value"] if "aggregations" in response else 0
+    else :
+        total = response["hits"]["total"]
+    return total, results
+
+def format_result(hit, highlight) :
+    """
+    Format a result : title, description (highlighted), url and thumbnail.
+    """
+    # highlight description (one fragment, see query.HIGHLIGHT)
+    title = hit["title"]
+    description = hit["description"]
+    if highlight :
+        if "description" in highlight :
+            description = highlight["description"][0]+"..."
+        elif "body" in highlight :
+            description = highlight["body"][0]+"..."
+
+    # create false title and description for better user experience (snippet computed at indexing)
+    if not title :
+        title = hit["domain"]
+    if not description and hit.get("snippet") :
+        description = hit["snippet"]+"..."
+
+    return {
+        "title":title,
+        "description":description,
+        "url":hit["url"],
+        "thumbnail":hit.get("thumbnail", None)
+    }
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Toolbox for page freshness.
+For each indexed page, the validators (ETag, Last-Modified), a hash of the extracted content
+and the outgoing links are saved in Redis, in order to :
+    - send conditional requests on recrawl (304 Not Modified responses have no body)
+    - skip language detection, extraction and indexing of pages whose content did not change
+    - keep following the links of pages not modified
+Saved work is counted (see stats).
+Pages indexed by an older version of the document build (DOCUMENT_VERSION) are fetched and indexed again,
+even if unchanged, so that they get the fields added since (snippet, suggest,...).
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import zlib
+import hashlib
+
+# lifetime of page data (seconds)
+PAGE_TTL = int(os.getenv("PAGE_TTL", 90*24*3600))
+
+# version of the documents built from pages (see crawler.analyze), increase it when fields are added or changed
+DOCUMENT_VERSION = 2
+
+def key(link) :
+    """
+    Redis key of page data.
+    """
+    return "page:%s"%hashlib.sha1(link.encode("utf8")).hexdigest()
+
+def header(headers, name) :
+    """
+    Get a header (string) from requests or Scrapy headers.
+    """
+    value = (headers or {}).get(name)
+    if isinstance(value, bytes) :
+        value = value.decode("latin1")
+    return value
+
+def conditional_headers(redis_conn, link) :
+    """
+    Headers of a conditional request on a page already indexed (none if its document is outdated).
+    """
+    etag, last_modified, version = redis_conn.hmget(key(link), ["etag", "last_modified", "version"])
+    headers = {}
+    if version is None or int(version) != DOCUMENT_VERSION :
+        return headers
+    if etag :
+        headers["If-None-Match"] = etag.decode("latin1")
+    if last_modified :
+        headers["If-Modified-Since"] = last_modified.decode("latin1")
+    return headers
+
+def content_hash(tree, metadata) :
+    """
+    Hash of the content of a parsed page : title, description, image and text (no scripts or styles),
+    and version of documents (an outdated document never looks unchanged).
+    """
+    h = hashlib.sha1(("%s\0"%DOCUMENT_VERSION).encode("utf8"))
+    for name in ["title", "description", "image"] :
+        h.update(metadata[name].encode("utf8"))
+        h.update(b"\0")
+    for text in tree.xpath("//body//text()[not(ancestor::script) and not(ancestor::style)]") :
+        text = text.strip()
+        if text :
+            h.update(text.encode("utf8"))
+            h.update(b" ")
+    return h.hexdigest()
+
+def saved_hash(redis_conn, link) :
+    """
+    Content hash of a page when it was indexed, or None.
+    """
+    saved = redis_conn.hget(key(link), "hash")
+    return saved.decode("utf8") if saved is not None else None
+
+def unchanged(redis_conn, link, digest) :
+    """
+    True if the page was already indexed with the same content.
+    """
+    return saved_hash(redis_conn, link) == digest
+
+def save(redis_conn, link, headers, digest, links=None) :
+    """
+    Save validators, content hash and outgoing links of an indexed page.
+    """
+    data = {"hash":digest, "etag":header(headers, "ETag") or "", "last_modified":header(headers, "Last-Modified") or "",
+        "version":DOCUMENT_VERSION}
+    if links is not None :
+        data["links"] = zlib.compress("\n".join(links).encode("utf8"))
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hmset(key(link), data)
+    pipe.expire(key(link), PAGE_TTL)
+    pipe.execute()
+
+def forget(redis_conn, pages) :
+    """
+    Forget validators and content hash of pages : indexed again at their next crawl, even if unchanged.
+    """
+    pipe = redis_conn.pipeline(transaction=False)
+    for link in pages :
+        pipe.hdel(key(link), "hash", "etag", "last_modified")
+    pipe.execute()
+
+def links(redis_conn, link) :
+    """
+    Saved outgoing links of a page.
+    """
+    data = redis_conn.hget(key(link), "links")
+    return zlib.decompress(data).decode("utf8").split("\n") if data else []
+
+def links_many(redis_conn, pages) :
+    """
+    Saved outgoing links of a list of pages, in one pipelined call.
+    """
+    pipe = redis_conn.pipeline(transaction=False)
+    for link in pages :
+        pipe.hget(key(link), "links")
+    return [zlib.decompress(data).decode("utf8").split("\n") if data else [] for data in pipe.execute()]
+
+def count(redis_conn, name) :
+    """
+    Count a page saved from work : "not_modified" (304 response) or "unchanged" (same content).
+    Indexed pages are counted as "changed".
+    """
+    redis_conn.hincrby("freshness:stats", name)
+
+def stats(redis_conn) :
+    """
+    Number of pages not modified, unchanged and changed, and share of pages saved from indexing.
+    """
+    counts = dict((name, 0) for name in ["not_modified", "unchanged", "changed"])
+    counts.update((name.decode("utf8"), int(value)) for name, value in redis_conn.hgetall("freshness:stats").items())
+    total = sum(counts.values())
+    counts["saved_rate"] = float(counts["not_modified"] + counts["unchanged"]) / total if total else 0.0
+    return counts
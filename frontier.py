@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Crawl frontier shared in Redis, used as Scrapy scheduler by the explore crawler.
+Several workers exploring the same website share its frontier :
+    - one queue per host, with a politeness delay (FRONTIER_DELAY seconds) and a maximum of
+      concurrent requests (FRONTIER_CONCURRENCY) between two requests on this host, for all workers
+    - a Bloom filter as seen-set of URLs, so an URL is fetched once per crawl : 10 bits per expected URL
+      (about 1% of false positives), FRONTIER_EXPECTED_URLS or FRONTIER_URLS_PER_PAGE per page of the
+      crawl limit (CLOSESPIDER_PAGECOUNT)
+    - leases : a request taken by a worker is leased until it leaves the downloader (response or error),
+      and given back to the frontier if the worker does not answer in time (FRONTIER_LEASE seconds)
+A new crawl of a website (new seen-set) starts when its frontier is empty. The frontier is deleted when
+a crawl ends with an empty frontier, and expires FRONTIER_TTL seconds after its last use otherwise.
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import pickle
+import time
+import hashlib
+from urllib.parse import urlparse
+import clients
+from scrapy import signals
+try :
+    from scrapy.utils.reqser import request_to_dict, request_from_dict
+except ImportError : # scrapy >= 2.6
+    from scrapy.utils.request import request_from_dict
+    request_to_dict = lambda request, spider : request.to_dict(spider=spider)
+
+# politeness (seconds between two requests on a host, concurrent requests per host), lease duration (seconds),
+# maximum number of attempts of a request, lifetime of an unused frontier (seconds),
+# and Bloom filter size (expected URLs of a crawl, 0 : from crawl limit) and number of hashes
+FRONTIER_DELAY = float(os.getenv("FRONTIER_DELAY", 0.25))
+FRONTIER_CONCURRENCY = int(os.getenv("FRONTIER_CONCURRENCY", 2))
+FRONTIER_LEASE = float(os.getenv("FRONTIER_LEASE", 300))
+FRONTIER_ATTEMPTS = int(os.getenv("FRONTIER_ATTEMPTS", 3))
+FRONTIER_TTL = int(os.getenv("FRONTIER_TTL", 24*3600))
+FRONTIER_EXPECTED_URLS = int(os.getenv("FRONTIER_EXPECTED_URLS", 0))
+FRONTIER_URLS_PER_PAGE = int(os.getenv("FRONTIER_URLS_PER_PAGE", 20))
+FRONTIER_BLOOM_HASHES = int(os.getenv("FRONTIER_BLOOM_HASHES", 7))
+
+# take a request from the first host ready (delay elapsed and concurrency not reached), and lease it
+LEASE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local hosts = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, 20)
+for _, host in ipairs(hosts) do
+    local active = tonumber(redis.call('HGET', KEYS[2], host) or '0')
+    if active >= tonumber(ARGV[3]) then
+        redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), host)
+    else
+        local item = redis.call('LPOP', ARGV[5] .. host)
+        if item then
+            redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), host)
+            redis.call('HINCRBY', KEYS[2], host, 1)
+            redis.call('ZADD', KEYS[3], now + tonumber(ARGV[4]), item)
+            return item
+        end
+        redis.call('ZREM', KEYS[1], host)
+    end
+end
+return false
+"""
+
+class Frontier(object):
+    """
+    Frontier of a website crawl, in Redis.
+    """
+    def __init__(self, redis_conn, site) :
+        self.redis_conn = redis_conn
+        self.prefix = "frontier:%s:"%site
+        self.lease_script = redis_conn.register_script(LEASE_SCRIPT)
+        self.bits = None # size of seen-set, shared by all workers of a crawl
+
+    def key(self, name) :
+        return self.prefix + name
+
+    def empty(self) :
+        """
+        True if no request is queued or leased.
+        """
+        return not self.redis_conn.zcard(self.key("hosts")) and not self.redis_conn.zcard(self.key("leases"))
+
+    def reset(self, expected_urls) :
+        """
+        Start a new crawl : clear seen-set and politeness data, size seen-set for expected_urls.
+        """
+        self.clear()
+        self.redis_conn.set(self.key("bits"), max(expected_urls, 1) * 10, ex=FRONTIER_TTL)
+
+    def join(self) :
+        """
+        Join the crawl running on website : read the size of its seen-set.
+        """
+        self.bits = int(self.redis_conn.get(self.key("bits")) or 0)
+        return self.bits
+
+    def clear(self) :
+        """
+        Delete the frontier (queues are deleted by Redis once empty).
+        """
+        self.redis_conn.delete(self.key("seen"), self.key("active"), self.key("hosts"), self.key("leases"), self.key("bits"))
+
+    def keep_alive(self) :
+        """
+        Postpone the expiration of the frontier (called periodically while crawling).
+        """
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for name in ["seen", "active", "hosts", "leases", "bits"] :
+            pipe.expire(self.key(name), FRONTIER_TTL)
+        pipe.execute()
+
+    def seen(self, link) :
+        """
+        Add an URL to the seen-set (Bloom filter), return True if it was (probably) already seen.
+        """
+        digest = hashlib.sha1(link.encode("utf8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for i in range(FRONTIER_BLOOM_HASHES) :
+            pipe.setbit(self.key("seen"), (h1 + i * h2) % self.bits, 1)
+        return all(pipe.execute())
+
+    def push(self, item, host) :
+        """
+        Queue a serialized (pickled) request on its host.
+        """
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pipe.rpush(self.key("queue:%s"%host), item)
+        pipe.expire(self.key("queue:%s"%host), FRONTIER_TTL)
+        pipe.zadd(self.key("hosts"), {host:time.time()}, nx=True)
+        pipe.execute()
+
+    def lease(self) :
+        """
+        Take a request ready to be fetched, or None.
+        """
+        item = self.lease_script(keys=[self.key("hosts"), self.key("active"), self.key("leases")],
+            args=[time.time(), FRONTIER_DELAY, FRONTIER_CONCURRENCY, FRONTIER_LEASE, self.key("queue:")])
+        return item or None
+
+    def release(self, item, host) :
+        """
+        Release the lease of a fetched request.
+        """
+        if self.redis_conn.zrem(self.key("leases"), item) :
+            self.redis_conn.hincrby(self.key("active"), host, -1)
+
+    def reclaim(self) :
+        """
+        Give back to the frontier the expired leases (worker lost), up to a maximum of attempts.
+        """
+        for item in self.redis_conn.zrangebyscore(self.key("leases"), 0, time.time()) :
+            data = pickle.loads(item)
+            host = urlparse(data["url"]).netloc
+            if not self.redis_conn.zrem(self.key("leases"), item) : # reclaimed by another worker
+                continue
+            self.redis_conn.hincrby(self.key("active"), host, -1)
+            data["attempts"] = data.get("attempts", 1) + 1
+            if data["attempts"] <= FRONTIER_ATTEMPTS :
+                self.push(pickle.dumps(data), host)
+
+class Scheduler(object):
+    """
+    Scrapy scheduler on the shared frontier of the website explored (first allowed domain of spider).
+    """
+    def __init__(self, crawler) :
+        self.crawler = crawler
+        self.frontier = None
+        self.last_reclaim = 0
+
+    @classmethod
+    def from_crawler(cls, crawler) :
+        return cls(crawler)
+
+    def open(self, spider) :
+        self.spider = spider
+        redis_conn = getattr(spider, "redis_conn", None) or clients.redis_conn
+        self.frontier = Frontier(redis_conn, spider.allowed_domains[0])
+        if self.frontier.empty() or not self.frontier.join() : # no crawl running on website, start a new one
+            self.frontier.reset(FRONTIER_EXPECTED_URLS or
+                FRONTIER_URLS_PER_PAGE * (self.crawler.settings.getint("CLOSESPIDER_PAGECOUNT") or 5000))
+            self.frontier.join()
+        spider.frontier = self.frontier
+        # a lease is released when its request leaves the downloader, with a response or an error
+        # (scrapy < 2.0 has no request_left_downloader signal : on error, lease expires and request is retried)
+        for signal in ["response_received", "request_dropped", "request_left_downloader"] :
+            if hasattr(signals, signal) :
+                self.crawler.signals.connect(self.release, signal=getattr(signals, signal))
+
+    def close(self, reason) :
+        if self.frontier.empty() : # crawl complete, seen-set no longer needed
+            self.frontier.clear()
+
+    def enqueue_request(self, request) :
+        if not request.dont_filter and self.frontier.seen(request.url) :
+            return False
+        data = request_to_dict(request, self.spider)
+        data["attempts"] = 1
+        self.frontier.push(pickle.dumps(data), urlparse(request.url).netloc)
+        return True
+
+    def next_request(self) :
+        if time.time() - self.last_reclaim > FRONTIER_LEASE / 10 :
+            self.frontier.reclaim()
+            self.frontier.keep_alive()
+            self.last_reclaim = time.time()
+        item = self.frontier.lease()
+        if item is None :
+            return None
+        data = pickle.loads(item)
+        data.pop("attempts", None)
+        request = request_from_dict(data, spider=self.spider)
+        request.meta["frontier_lease"] = item
+        return request
+
+    def release(self, request, spider, **kwargs) :
+        """
+        Release the lease of a request, once it is fetched or dropped (released once, see Frontier.release).
+        """
+        item = request.meta.get("frontier_lease")
+        if item :
+            self.frontier.release(item, urlparse(request.url).netloc)
+
+    def has_pending_requests(self) :
+        return not self.frontier.empty()
+
+    def __len__(self) :
+        # number of hosts with queued requests and of leased requests (approximation of pending requests)
+        return self.frontier.redis_conn.zcard(self.frontier.key("hosts")) + self.frontier.redis_conn.zcard(self.frontier.key("leases"))
@@ -22,22 +22,24 @@ __email__ = "anthony@byprog.com"
 __license__ = "MIT"
 __version__ = "1.0"
 
-import re
 import os
 import url
 import crawler
-import requests
-import json
-import query
-from flask import Flask, request, jsonify
-from elasticsearch_dsl.connections import connections
-from elasticsearch_dsl import Index, Search, Mapping
-from language import languages
-from redis import Redis
+import crawl_daemon
+import engine
+import suggest
+import uuid
+import cache
+import freshness
+import scheduler
+import clients
+import metrics
+from flask import Flask, Response, request, jsonify
+import language
 from rq import Queue
 from rq.decorators import job
 from scrapy.crawler import CrawlerProcess
-from urllib.parse import urlparse
+from bulk import BulkIndexer
 from datetime import datetime
 
 # init flask app and import helper
@@ -45,47 +47,16 @@ app = Flask(__name__)
 with app.app_context():
     from helper import *
 
-# initiate the elasticsearch connection
-hosts = [os.getenv("HOST")]
-http_auth = (os.getenv("USERNAME"), os.getenv("PASSWORD"))
-port = os.getenv("PORT")
-client = connections.create_connection(hosts=hosts, http_auth=http_auth, port=port)
-
-# initiate Redis connection
-redis_conn = Redis(os.getenv("REDIS_HOST", "redis"), os.getenv("REDIS_PORT", 6379))
-
-# create indices and mappings
-for lang in ["fr"] : #languages :
-    # index named "web-<language code>"
-    index = Index('web-%s'%lang)
-    if not index.exists() :
-        index.create()
-
-    # mapping of page
-    m = Mapping('page')
-    m.field('url', 'keyword')
-    m.field('domain', 'keyword')
-    m.field('title', 'text', analyzer=languages[lang])
-    m.field('description', 'text', analyzer=languages[lang])
-    m.field('body', 'text', analyzer=languages[lang])
-    m.field('weight', 'long')
-    #m.field('thumbnail', 'binary')
-    #m.field('keywords', 'completion') # -- TEST -- #
-    m.save('web-%s'%lang)
-
-# index for misc mappings
-index = Index('web')
-if not index.exists() :
-    index.create()
-
-# mapping of domain
-m = Mapping('domain')
-m.field('homepage', 'keyword')
-m.field('domain', 'keyword')
-m.field('email', 'keyword')
-m.field('last_crawl', 'date')
-#m.field('keywords', 'text', analyzer=languages[lang])
-m.save('web')
+# elasticsearch and redis connections (shared, created at first use)
+client = clients.elastic
+redis_conn = clients.redis_conn
+
+# batch indexing : number of jobs enqueued per redis pipeline, and lifetime of batch progress
+BATCH_CHUNK = int(os.getenv("BATCH_CHUNK", 1000))
+BATCH_TTL = int(os.getenv("BATCH_TTL", 7*24*3600))
+
+# crawl backend : "rq" (one rq job per crawl) or "daemon" (long-lived crawl daemon, see crawl_daemon.py)
+CRAWL_BACKEND = os.getenv("CRAWL_BACKEND", "rq")
 
 @app.route("/index", methods=['POST'])
 def index():
@@ -102,34 +73,139 @@ def index():
     if "url" not in data :
         raise InvalidUsage('No url specified in POST data')
 
-    # launch exploration job
-    index_job.delay(data["url"])
+    # launch indexing job
+    if CRAWL_BACKEND == "daemon" :
+        crawl_daemon.submit(redis_conn, "index", data["url"])
+    else :
+        index_job.delay(data["url"])
 
     return "Indexing started"
 
+@app.route("/index/batch", methods=['POST'])
+def index_batch():
+    """
+    URL : /index/batch
+    Index a list of URLs in search engine.
+    Method : POST
+    Data : the urls to index, as
+        - a JSON list of urls [application/json]
+        - an uploaded file named "urls", one url per line [multipart/form-data]
+        - the request body, one url per line, can be streamed [text/plain]
+    Return the batch id (to follow progress at /index/batch/<id>) and the number of queued urls.
+    """
+    # get urls, as a list or as a stream of lines
+    if request.is_json :
+        lines = request.get_json()
+        if not isinstance(lines, list) :
+            raise InvalidUsage('JSON data must be a list of urls')
+    elif "urls" in request.files :
+        lines = request.files["urls"].stream
+    else :
+        lines = request.stream
+
+    batch = uuid.uuid4().hex
+    key = "batch:%s"%batch
+    seen = set()
+    pending = []
+    invalid = 0
+    for line in lines :
+        if isinstance(line, bytes) :
+            line = line.decode("utf8", "ignore")
+        if not isinstance(line, str) :
+            invalid += 1
+            continue
+        if not line.strip() : # skip empty lines
+            continue
+        link = url.normalize(line)
+        if not link :
+            invalid += 1
+            continue
+        if link in seen : # duplicate in batch
+            continue
+        seen.add(link)
+        pending.append(link)
+        if len(pending) >= BATCH_CHUNK :
+            enqueue_batch(pending, batch)
+            pending = []
+    if pending :
+        enqueue_batch(pending, batch)
+
+    if not seen :
+        raise InvalidUsage('No valid url in batch')
+
+    # save batch summary
+    redis_conn.hmset(key, {"invalid":invalid, "created":datetime.now().isoformat()})
+    redis_conn.expire(key, BATCH_TTL)
+
+    return jsonify(batch=batch, queued=len(seen), invalid=invalid)
+
+@app.route("/index/batch/<batch>", methods=['GET'])
+def index_batch_progress(batch):
+    """
+    URL : /index/batch/<id>
+    Progress of a batch of urls to index.
+    Method : GET
+    Return the number of queued, done and failed urls of the batch.
+    """
+    data = redis_conn.hgetall("batch:%s"%batch)
+    if not data :
+        raise InvalidUsage('Unknown batch', status_code=404)
+    data = dict((key.decode("utf8"), value.decode("utf8")) for key, value in data.items())
+    progress = dict((key, int(data.get(key, 0))) for key in ["queued", "done", "failed", "invalid"])
+    progress["created"] = data.get("created")
+    return jsonify(batch=batch, **progress)
+
+def enqueue_batch(links, batch) :
+    """
+    Queue the indexing of a list of urls, in one pipelined redis call.
+    """
+    if CRAWL_BACKEND == "daemon" :
+        pipe = redis_conn.pipeline(transaction=False)
+        for link in links :
+            crawl_daemon.submit(redis_conn, "index", link, batch, pipeline=pipe)
+        pipe.execute()
+    else :
+        Queue(connection=redis_conn).enqueue_many([Queue.prepare_data(index_job, args=(link, batch)) for link in links])
+    redis_conn.hincrby("batch:%s"%batch, "queued", len(links))
+
+def batch_progress(batch, state) :
+    """
+    Count one more url in a state ("done" or "failed") for a batch of urls.
+    """
+    if batch :
+        redis_conn.hincrby("batch:%s"%batch, state)
+
 @job('default', connection=redis_conn)
-def index_job(link) :
+def index_job(link, batch=None) :
     """
     Index a single page.
     """
     print("index page : %s"%link)
 
-    # get final url after possible redictions
-    try :
-        link = url.crawl(link).url
-    except :
+    # fetch page once, redirections included (conditional request if page already indexed)
+    headers = {"User-Agent":crawler.USER_AGENT}
+    headers.update(freshness.conditional_headers(redis_conn, link))
+    with metrics.timer("fetch") :
+        r = url.fetch(link, headers=headers)
+    if r is not None and r.status_code == 304 : # not modified
+        freshness.count(redis_conn, "not_modified")
+        scheduler.observe(redis_conn, link, changed=False)
+        batch_progress(batch, "done")
+        metrics.flush() # end of job
+        return 1
+    if r is None or not 200 <= r.status_code < 300 :
+        batch_progress(batch, "failed")
+        metrics.incr("pages_fetch_failed")
+        metrics.flush()
         return 0
 
-    process = CrawlerProcess({
-        'USER_AGENT': "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.75 Safari/537.36",
-        'DOWNLOAD_TIMEOUT':100,
-        'REDIRECT_ENABLED':False,
-        'SPIDER_MIDDLEWARES' : {
-            'scrapy.spidermiddlewares.httperror.HttpErrorMiddleware':True
-        }
-    })
-    process.crawl(crawler.SingleSpider, start_urls=[link,], es_client=client, redis_conn=redis_conn)
-    process.start() # block until finished
+    # index page
+    spider = crawler.SingleSpider(es_client=client, redis_conn=redis_conn, sink=BulkIndexer(client, redis_conn=redis_conn))
+    crawler.pipeline(crawler.response_from_fetch(r), spider)
+    spider.sink.flush()
+    batch_progress(batch, "done")
+    metrics.flush()
+    return 1
 
 @app.route("/explore", methods=['POST'])
 def explore():
@@ -147,7 +223,10 @@ def explore():
         raise InvalidUsage('No url specified in POST data')
 
     # launch exploration job
-    explore_job.delay(data["url"])
+    if CRAWL_BACKEND == "daemon" :
+        crawl_daemon.submit(redis_conn, "explore", data["url"])
+    else :
+        explore_job.delay(data["url"])
 
     return "Exploration started"
 
@@ -158,38 +237,20 @@ def explore_job(link) :
     """
     print("explore website at : %s"%link)
 
-    # get final url after possible redictions
-    try :
-        link = url.crawl(link).url
-    except :
-        return 0
-
-    # create or update domain data
-    domain = url.domain(link)
+    # create or update domain data (final homepage is saved by crawler, after redirections)
+    domain = url.site(link)
     res = client.index(index="web", doc_type='domain', id=domain, body={
         "homepage":link,
         "domain":domain,
         "last_crawl":datetime.now()
     })
+    scheduler.add_domain(redis_conn, domain, link)
 
-    # start crawler
-    process = CrawlerProcess({
-        'USER_AGENT': "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.75 Safari/537.36",
-        'DOWNLOAD_TIMEOUT':100,
-        'DOWNLOAD_DELAY':0.25,
-        'ROBOTSTXT_OBEY':True,
-        'HTTPCACHE_ENABLED':False,
-        'REDIRECT_ENABLED':False,
-        'SPIDER_MIDDLEWARES' : {
-            'scrapy.downloadermiddlewares.robotstxt.RobotsTxtMiddleware':True,
-            'scrapy.spidermiddlewares.httperror.HttpErrorMiddleware':True,
-            'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware':True,
-            'scrapy.extensions.closespider.CloseSpider':True
-        },
-        'CLOSESPIDER_PAGECOUNT':500 #only for debug
-    })
-    process.crawl(crawler.Crawler, allowed_domains=[urlparse(link).netloc], start_urls = [link,], es_client=client, redis_conn=redis_conn)
+    # start crawler, on the whole registered domain (redirections to www, https,...)
+    process = CrawlerProcess(crawler.EXPLORE_SETTINGS)
+    process.crawl(crawler.Crawler, allowed_domains=[domain], start_urls = [link,], es_client=client, redis_conn=redis_conn)
     process.start()
+    metrics.flush() # end of job
 
     return 1
 
@@ -221,14 +282,14 @@ def reference_job(link, email) :
     """
     print("referencing page %s with email %s"%(link,email))
 
-    # get final url after possible redictions
-    try :
-        link = url.crawl(link).url
-    except :
+    # get final url after possible redictions (headers only)
+    r = url.fetch(link, headers={"User-Agent":crawler.USER_AGENT}, max_bytes=0)
+    if r is None :
         return 0
+    link = r.url
 
     # create or update domain data
-    domain = url.domain(link)
+    domain = url.site(link)
     res = client.index(index="web", doc_type='domain', id=domain, body={
         "homepage":link,
         "domain":domain,
@@ -247,65 +308,80 @@ def search():
         - query : the search query [string, required]
         - hits : the number of hits returned by query [integer, optional, default:10]
         - start : the start of hits [integer, optional, default:0]
+        - lang : the languages of results, comma separated codes [string, optional, default:language detected in query, or all languages]
     Return a sublist of matching URLs sorted by relevance, and the total of matching URLs.
+    Header X-Search-Took is the time spent in ElasticSearch (milliseconds, searches not served from cache).
     """
-    def format_result(hit, highlight) :
-        # highlight title and description
-        title = hit["title"]
-        description = hit["description"]
-        if highlight :
-            if "description" in highlight :
-                description = highlight["description"][0]+"..."
-            elif "body" in highlight :
-                description = highlight["body"][0]+"..."
-            """if "title" in highlight :
-                title = highlight["title"][0]"""
-
-        # create false title and description for better user experience
-        if not title :
-            title = hit["domain"]
-        if not description :
-            description = url.create_description(hit["body"])+"..."
-
-        return {
-            "title":title,
-            "description":description,
-            "url":hit["url"],
-            "thumbnail":hit.get("thumbnail", None)
-        }
-
-    # get POST data
+    # get POST data
     data = dict((key, request.form.get(key)) for key in request.form.keys())
-    if "query" not in data :
-        raise InvalidUsage('No query specified in POST data')
-    start = int(data.get("start", "0"))
-    hits = int(data.get("hits", "10"))
-    if start < 0 or hits < 0 :
-        raise InvalidUsage('Start or hits cannot be negative numbers')
-
-    # analyze user query
-    groups = re.search("(site:(?P<domain>[^ ]+))?( ?(?P<query>.*))?",data["query"]).groupdict()
-    if groups.get("query", False) and groups.get("domain", False) :
-        # expression in domain query
-        response = client.search(index="web-*", doc_type="page", body=query.domain_expression_query(groups["domain"], groups["query"]), from_=start, size=hits)
-        results = [format_result(hit["_source"], hit.get("highlight", None)) for hit in response["hits"]["hits"]]
-        total = response["hits"]["total"]
-
-    elif groups.get("domain", False) :
-        # domain query
-        response = client.search(index="web-*", doc_type="page", body=query.domain_query(groups["domain"]), from_=start, size=hits)
-        results = [format_result(hit["_source"], None) for hit in response["hits"]["hits"]]
-        total = response["hits"]["total"]
-
-    elif groups.get("query", False) :
-        # expression query
-        response = client.search(index="web-*", doc_type="page", body=query.expression_query(groups["query"]))
-        results = []
-        for domain_bucket in response['aggregations']['per_domain']['buckets']:
-            for hit in domain_bucket["top_results"]["hits"]["hits"] :
-                results.append((format_result(hit["_source"], hit.get("highlight", None)),hit["_score"]))
-        results = [result[0] for result in sorted(results, key=lambda result: result[1], reverse=True)]
-        total = len(results)
-        results = results[start:start+hits]
-
-    return jsonify(total=total, results=results)
+    try :
+        with metrics.timer("query_build") :
+            plan = engine.plan(data)
+            body = engine.body(plan)
+    except ValueError as e :
+        raise InvalidUsage(str(e))
+
+    # get results from cache, if any
+    cache_key = cache.key(redis_conn, engine.cache_indices(plan), plan["query"], plan["domain"], plan["start"], plan["hits"])
+    cached = cache.get(redis_conn, cache_key)
+    if cached is not None :
+        return jsonify(**cached)
+
+    def run_search(index) :
+        with metrics.timer("es_search") :
+            response = client.search(index=index, doc_type="page", body=body, from_=plan["start"], size=plan["hits"], ignore_unavailable=True)
+        took = response.get("took", 0)
+        metrics.observe("es_took", took / 1000.0)
+        with metrics.timer("format") :
+            return engine.results(plan, response) + (took,)
+
+    total, results, took = run_search(plan["index"])
+    if plan["detected"] and not total :
+        # no result in detected language, probably a wrong detection : search in all languages
+        total, results, fallback_took = run_search(engine.ALL_INDICES)
+        took += fallback_took
+    cache.put(redis_conn, cache_key, {"total":total, "results":results})
+
+    response = jsonify(total=total, results=results)
+    response.headers["X-Search-Took"] = str(took)
+    return response
+
+@app.route("/suggest", methods=['GET', 'POST'])
+def suggest_endpoint():
+    """
+    URL : /suggest
+    Query autocomplete : suggestions of queries starting with a prefix.
+    Method : GET or POST
+    Parameters :
+        - prefix : the beginning of the query [string, required]
+        - size : the number of suggestions [integer, optional, default:10]
+        - lang : the languages of suggestions, comma separated codes [string, optional, default:all languages]
+    Return a list of suggestions, best first.
+    """
+    try :
+        prefix, index, size = suggest.plan(request.values)
+    except ValueError as e :
+        raise InvalidUsage(str(e))
+    return jsonify(suggestions=suggest.suggest(client, prefix, index, size))
+
+@app.route("/stats", methods=['GET'])
+def stats():
+    """
+    URL : /stats
+    Statistics of search engine.
+    Method : GET
+    Return the statistics of language detection (pages per detection tier and hit rate),
+    of search results cache (hits, misses, evictions, hit rate and size),
+    and of recrawled pages (not modified, unchanged and changed pages).
+    """
+    return jsonify(language=language.stats(redis_conn), cache=cache.stats(redis_conn), freshness=freshness.stats(redis_conn))
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    """
+    URL : /metrics
+    Metrics of search engine, in the Prometheus text format.
+    Method : GET
+    Return the duration histograms of indexing and search stages, event counters and depth of crawl queues.
+    """
+    return Response(metrics.render(redis_conn), mimetype="text/plain")
@@ -11,6 +11,10 @@ __email__ = "anthony@byprog.com"
 __license__ = "MIT"
 __version__ = "1.0"
 
+import os
+import url
+import langdetect
+
 # declare a dictionary of languages (code -> long form)
 languages = {
     "fr": "french",
@@ -41,3 +45,90 @@ languages = {
     "fa": "persian",
     "lv": "latvian"
 }
+
+# a domain is considered monolingual after this number of detected pages, if its main language has this share of pages
+DOMAIN_MIN_PAGES = int(os.getenv("LANGUAGE_DOMAIN_MIN_PAGES", 20))
+DOMAIN_MIN_SHARE = float(os.getenv("LANGUAGE_DOMAIN_MIN_SHARE", 0.95))
+
+# minimum probability of the language detected in a search query
+QUERY_MIN_PROBABILITY = float(os.getenv("LANGUAGE_QUERY_MIN_PROBABILITY", 0.9))
+
+# in-process cache of monolingual domains (domain -> language)
+domain_languages = {}
+
+def domain_language(domain, redis_conn) :
+    """
+    Get the main language of a monolingual domain (cached in Redis), or None.
+    """
+    if domain in domain_languages :
+        return domain_languages[domain]
+    counts = dict((lang.decode("utf8"), int(count)) for lang, count in redis_conn.hgetall("language:domain:%s"%domain).items())
+    total = sum(counts.values())
+    if total < DOMAIN_MIN_PAGES :
+        return None
+    lang = max(sorted(counts), key=lambda lang : counts[lang])
+    if counts[lang] < total * DOMAIN_MIN_SHARE :
+        return None
+    domain_languages[domain] = lang
+    return lang
+
+def detect(html, domain, redis_conn, headers=None) :
+    """
+    Detect the language of a page, in tiers :
+        - language declared by page (<html lang> or Content-Language header)
+        - main language of domain, if domain is monolingual
+        - detection on a sample of text
+    Each tier used is counted in Redis (see stats).
+    """
+    tier, lang = detect_tier(html, lambda : domain_language(domain, redis_conn), headers)
+    count(redis_conn, domain, tier, lang)
+    return lang
+
+def detect_tier(html, domain_lang, headers=None) :
+    """
+    Detect the language of a page, without Redis (see detect).
+    domain_lang is the main language of domain (None if not monolingual), or a function returning it.
+    Return the tier used and the language.
+    """
+    hint = url.language_hint(html, headers)
+    if hint in languages :
+        return "hint", hint
+    lang = domain_lang() if callable(domain_lang) else domain_lang
+    if lang :
+        return "domain", lang
+    return "detect", url.detect_language(html)
+
+def count(redis_conn, domain, tier, lang) :
+    """
+    Count the tier of a detection, and the language of domain (see domain_language).
+    """
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hincrby("language:stats", tier)
+    if lang and tier != "domain" :
+        pipe.hincrby("language:domain:%s"%domain, lang)
+    pipe.execute()
+
+def detect_query(query) :
+    """
+    Detect the language of a search query.
+    Return the language code if detection is reliable and language supported, else None.
+    """
+    if len(query.split()) < 2 : # too short to be reliable
+        return None
+    try :
+        guesses = langdetect.detect_langs(query)
+    except langdetect.LangDetectException :
+        return None
+    if guesses and guesses[0].prob >= QUERY_MIN_PROBABILITY and guesses[0].lang in languages :
+        return guesses[0].lang
+    return None
+
+def stats(redis_conn) :
+    """
+    Number of pages per detection tier, and hit rate (share of pages without full detection).
+    """
+    counts = dict((tier, 0) for tier in ["hint", "domain", "detect"])
+    counts.update((tier.decode("utf8"), int(count)) for tier, count in redis_conn.hgetall("language:stats").items())
+    total = sum(counts.values())
+    counts["hit_rate"] = float(counts["hint"] + counts["domain"]) / total if total else 0.0
+    return counts
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load generator and latency benchmark of searches.
+Queries are replayed from a query log, or drawn from a synthetic mix of expression queries,
+"site:" queries and "site:" + expression queries, at a target rate (open loop : a slow response
+does not delay the next requests, latency is measured from the time a request should have been sent).
+
+Two targets :
+    - api : POST /search on a running API (end-to-end time, cache included, and ElasticSearch "took" time
+      of searches not served from cache, from header X-Search-Took)
+    - elastic : searches sent directly to ElasticSearch (HOST, PORT, USERNAME, PASSWORD), with the
+      query builders of query.py or of another module (--builders), to compare query variants.
+      ElasticSearch "took" time is reported beside end-to-end time.
+Use a local ElasticSearch node (see docker-compose.yml) or a real cluster.
+
+Reports p50/p95/p99 latency, error rate and achieved rate.
+
+Usage :
+    python loadtest.py --api http://localhost:5000 --rate 50 --duration 60
+    python loadtest.py --elastic --log queries.txt --rate 200 --concurrency 64
+    python loadtest.py --elastic --builders query_variant --mix 0,50,50
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import importlib
+import threading
+import requests
+import url
+from concurrent.futures import ThreadPoolExecutor
+
+# default words and domains of synthetic queries
+WORDS = ("france president election europe economy crisis government football world cup climate "
+         "paris health reform market strike police tax energy syria china russia africa elections "
+         "monde gouvernement économie santé grève réforme élection politique football climat").split()
+DOMAINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "demo_list_urls_english.txt")
+
+def load_queries(path) :
+    """
+    Queries of a query log : one query per line, or JSON lines with a "query" field (and optional "lang").
+    Return a list of search form data.
+    """
+    queries = []
+    with open(path) as f :
+        for line in f :
+            line = line.strip()
+            if not line :
+                continue
+            if line.startswith("{") :
+                data = json.loads(line)
+                queries.append(dict((key, str(data[key])) for key in ["query", "lang", "hits", "start"] if key in data))
+            else :
+                queries.append({"query":line})
+    return queries
+
+def load_domains(path) :
+    """
+    Domains of a list of urls (one per line), as indexed (registered domain).
+    """
+    domains = set()
+    with open(path) as f :
+        for line in f :
+            domain = url.domain(line.strip()) if line.strip() else None
+            if domain :
+                domains.add(domain)
+    return sorted(domains)
+
+def synthetic_queries(count, mix, domains, seed=0) :
+    """
+    Synthetic mix of queries : mix is the share of (expression, site:, site: + expression) queries.
+    """
+    rng = random.Random(seed)
+    expression = lambda : " ".join(rng.choice(WORDS) for i in range(rng.randint(1, 3)))
+    total = float(sum(mix))
+    queries = []
+    for i in range(count) :
+        draw = rng.random() * total
+        if draw < mix[0] or not domains :
+            queries.append({"query":expression()})
+        elif draw < mix[0] + mix[1] :
+            queries.append({"query":"site:%s"%rng.choice(domains)})
+        else :
+            queries.append({"query":"site:%s %s"%(rng.choice(domains), expression())})
+    return queries
+
+class ApiTarget(object):
+    """
+    Searches on a running API.
+    """
+    def __init__(self, api) :
+        self.url = api.rstrip("/") + "/search"
+        self.local = threading.local()
+
+    def search(self, data) :
+        """
+        Run a search, return the ElasticSearch took time (seconds) if known.
+        """
+        session = getattr(self.local, "session", None)
+        if session is None :
+            session = self.local.session = requests.Session()
+        r = session.post(self.url, data=data, timeout=30)
+        r.raise_for_status()
+        r.json()
+        took = r.headers.get("X-Search-Took") # absent if served from cache
+        return float(took) / 1000.0 if took is not None else None
+
+class ElasticTarget(object):
+    """
+    Searches sent directly to ElasticSearch, with a module of query builders.
+    """
+    def __init__(self, builders) :
+        import clients
+        import engine
+        self.engine = engine
+        self.client = clients.create_elastic()
+        self.builders = importlib.import_module(builders)
+
+    def search(self, data) :
+        plan = self.engine.plan(data)
+        response = self.client.search(index=plan["index"], doc_type="page", body=self.engine.body(plan, self.builders),
+            from_=plan["start"], size=plan["hits"], ignore_unavailable=True)
+        self.engine.results(plan, response)
+        return response["took"] / 1000.0
+
+def percentiles(values) :
+    values = sorted(values)
+    if not values :
+        return {}
+    return dict((name, values[int(q * (len(values) - 1))] * 1000) for name, q in [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)])
+
+def run(target, queries, rate, duration, concurrency) :
+    """
+    Send searches at a target rate (per second) during duration seconds, with at most concurrency searches at once.
+    Return the results of the load test.
+    """
+    latencies, tooks, errors = [], [], []
+    lock = threading.Lock()
+
+    def send(data, scheduled) :
+        try :
+            took = target.search(data)
+        except Exception as e :
+            with lock :
+                errors.append(str(e))
+            return
+        latency = time.time() - scheduled
+        with lock :
+            latencies.append(latency)
+            if took is not None :
+                tooks.append(took)
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    start = time.time()
+    sent = 0
+    while True :
+        scheduled = start + sent / float(rate)
+        if scheduled - start >= duration :
+            break
+        delay = scheduled - time.time()
+        if delay > 0 :
+            time.sleep(delay)
+        executor.submit(send, queries[sent % len(queries)], scheduled)
+        sent += 1
+    executor.shutdown(wait=True)
+    elapsed = time.time() - start
+
+    results = {
+        "sent":sent,
+        "completed":len(latencies),
+        "errors":len(errors),
+        "error_rate":len(errors) / float(sent) if sent else 0,
+        "rate":len(latencies) / elapsed if elapsed else 0,
+        "latency_ms":percentiles(latencies)
+    }
+    if tooks :
+        results["took_ms"] = percentiles(tooks)
+    if errors :
+        results["first_error"] = errors[0]
+    return results
+
+def report(results) :
+    print("%s searches sent, %s completed (%.1f/s), %s errors (%.2f%%)"%(
+        results["sent"], results["completed"], results["rate"], results["errors"], results["error_rate"] * 100))
+    for name in ["latency_ms", "took_ms"] :
+        if results.get(name) :
+            print("%-12s p50 %8.1f   p95 %8.1f   p99 %8.1f"%(
+                "end-to-end" if name == "latency_ms" else "took", results[name]["p50"], results[name]["p95"], results[name]["p99"]))
+    if "first_error" in results :
+        print("first error : %s"%results["first_error"])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of searches.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--api", help="url of a running API (ex : http://localhost:5000)")
+    target.add_argument("--elastic", action="store_true", help="search directly in ElasticSearch (HOST, PORT, USERNAME, PASSWORD)")
+    parser.add_argument("--builders", default="query", help="module of query builders, with --elastic (default : query)")
+    parser.add_argument("--log", help="query log (one query per line, or JSON lines)")
+    parser.add_argument("--mix", default="70,15,15", help="share of expression, site: and site: + expression synthetic queries")
+    parser.add_argument("--domains", default=DOMAINS_FILE, help="list of urls, domains of synthetic site: queries")
+    parser.add_argument("--rate", type=float, default=20, help="searches per second")
+    parser.add_argument("--duration", type=float, default=30, help="duration of test (seconds)")
+    parser.add_argument("--concurrency", type=int, default=32, help="maximum of concurrent searches")
+    parser.add_argument("--seed", type=int, default=0, help="seed of synthetic queries")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    if args.log :
+        queries = load_queries(args.log)
+    else :
+        mix = [float(share) for share in args.mix.split(",")]
+        queries = synthetic_queries(max(1, int(args.rate * args.duration)), mix, load_domains(args.domains), args.seed)
+    if not queries :
+        print("no query to send")
+        sys.exit(1)
+
+    target = ApiTarget(args.api) if args.api else ElasticTarget(args.builders)
+    results = run(target, queries, args.rate, args.duration, args.concurrency)
+    if args.json :
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else :
+        report(results)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Metrics of the search engine - timings of indexing and search stages, counters and queue depths,
+exposed in the Prometheus text format.
+Metrics are aggregated in Redis, so that all processes (API, rq workers whose jobs run in forked processes,
+crawl daemon) report to the same histograms. Each process buffers its observations, and a background
+thread sends them in one pipelined call every METRICS_INTERVAL seconds (jobs also send them when they end) :
+recording a metric never waits for Redis.
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+# upper bounds of histogram buckets (seconds), and delay between two sends of buffered metrics (seconds)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 1))
+
+# buffered observations : {stage:[count, sum, [count per bucket]]} and {counter:value}
+timings = {}
+counters = {}
+last_flush = time.time()
+lock = threading.Lock()
+flusher_pid = None # process running the background flush (threads do not survive a fork)
+
+def redis() :
+    import clients
+    return clients.redis_conn
+
+def observe(stage, seconds) :
+    """
+    Record the duration of a stage.
+    """
+    with lock :
+        timing = timings.setdefault(stage, [0, 0.0, [0]*len(BUCKETS)])
+        timing[0] += 1
+        timing[1] += seconds
+        for i, bound in enumerate(BUCKETS) :
+            if seconds <= bound :
+                timing[2][i] += 1
+                break
+    start_flusher()
+
+@contextmanager
+def timer(stage) :
+    """
+    Time a block of code as a stage.
+    """
+    start = time.time()
+    try :
+        yield
+    finally :
+        observe(stage, time.time() - start)
+
+def incr(name, value=1) :
+    """
+    Increment a counter.
+    """
+    with lock :
+        counters[name] = counters.get(name, 0) + value
+    start_flusher()
+
+def start_flusher() :
+    """
+    Start the background thread sending buffered metrics, once per process.
+    """
+    global flusher_pid
+    if flusher_pid == os.getpid() :
+        return
+    with lock :
+        if flusher_pid == os.getpid() :
+            return
+        flusher_pid = os.getpid()
+    threading.Thread(target=flush_loop, name="metrics", daemon=True).start()
+
+def flush_loop() :
+    """
+    Send buffered metrics every METRICS_INTERVAL seconds.
+    """
+    while True :
+        time.sleep(min(METRICS_INTERVAL, 1.0))
+        if time.time() - last_flush >= METRICS_INTERVAL :
+            flush()
+
+def flush(redis_conn=None) :
+    """
+    Send buffered metrics to Redis, in one pipelined call.
+    """
+    global timings, counters, last_flush
+    with lock :
+        buffered_timings, buffered_counters = timings, counters
+        timings, counters, last_flush = {}, {}, time.time()
+    if not buffered_timings and not buffered_counters :
+        return
+    try :
+        pipe = (redis_conn or redis()).pipeline(transaction=False)
+        for stage, (count, total, buckets) in buffered_timings.items() :
+            key = "metrics:timing:%s"%stage
+            pipe.hincrby(key, "count", count)
+            pipe.hincrbyfloat(key, "sum", total)
+            for bound, bucket in zip(BUCKETS, buckets) :
+                if bucket :
+                    pipe.hincrby(key, str(bound), bucket)
+            pipe.sadd("metrics:stages", stage)
+        for name, value in buffered_counters.items() :
+            pipe.hincrby("metrics:counters", name, value)
+        pipe.execute()
+    except Exception as e :
+        # metrics are never a reason to fail indexing or searching
+        print("metrics error : %s"%e)
+
+atexit.register(flush)
+
+def render(redis_conn) :
+    """
+    All metrics, in the Prometheus text format.
+    """
+    from rq import Queue
+    import crawl_daemon
+    flush(redis_conn)
+    lines = []
+
+    # stage timings (cumulative histograms)
+    lines.append("# HELP search_engine_stage_seconds Duration of indexing and search stages.")
+    lines.append("# TYPE search_engine_stage_seconds histogram")
+    for stage in sorted(s.decode("utf8") for s in redis_conn.smembers("metrics:stages")) :
+        data = redis_conn.hgetall("metrics:timing:%s"%stage)
+        data = dict((key.decode("utf8"), value.decode("utf8")) for key, value in data.items())
+        cumulative = 0
+        for bound in BUCKETS :
+            cumulative += int(data.get(str(bound), 0))
+            lines.append('search_engine_stage_seconds_bucket{stage="%s",le="%s"} %s'%(stage, bound, cumulative))
+        lines.append('search_engine_stage_seconds_bucket{stage="%s",le="+Inf"} %s'%(stage, data.get("count", 0)))
+        lines.append('search_engine_stage_seconds_sum{stage="%s"} %s'%(stage, data.get("sum", 0)))
+        lines.append('search_engine_stage_seconds_count{stage="%s"} %s'%(stage, data.get("count", 0)))
+
+    # counters
+    lines.append("# HELP search_engine_events_total Indexing and search events.")
+    lines.append("# TYPE search_engine_events_total counter")
+    for name, value in sorted(redis_conn.hgetall("metrics:counters").items()) :
+        lines.append('search_engine_events_total{event="%s"} %s'%(name.decode("utf8"), int(value)))
+
+    # depth of crawl queues
+    lines.append("# HELP search_engine_queue_depth Jobs waiting in queues.")
+    lines.append("# TYPE search_engine_queue_depth gauge")
+    for queue in Queue.all(connection=redis_conn) :
+        lines.append('search_engine_queue_depth{queue="rq:%s"} %s'%(queue.name, queue.count))
+    for queue in sorted(crawl_daemon.QUEUES.values()) :
+        lines.append('search_engine_queue_depth{queue="%s"} %s'%(queue, redis_conn.llen(queue)))
+
+    return "\n".join(lines)+"\n"
+
+def serve(port, redis_conn) :
+    """
+    Serve /metrics on a port, in a background thread (rq workers, crawl daemon).
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler) :
+        def do_GET(self) :
+            if self.path != "/metrics" :
+                self.send_error(404)
+                return
+            body = render(redis_conn).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) :
+            pass
+
+    server = HTTPServer(("", port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Static rank of pages (PageRank), computed offline from the link graph of crawled pages.
+Nodes are the indexed pages, edges the outgoing links saved with each page (see freshness.py).
+The rank is computed by power iteration on a sparse matrix, then written into pages (field "rank",
+with bulk partial updates), and used as a precomputed factor of the score of searches (see query.py).
+Ranks are scaled to a mean of 1 (a page without rank counts as 1).
+
+Run periodically (a full computation reads all pages) :
+    HOST=<ip> PORT=<port> USERNAME=<username> PASSWORD=<password> python pagerank.py
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import time
+import numpy as np
+import scipy.sparse as sparse
+import url
+import schema
+import freshness
+from bulk import BulkIndexer
+from language import languages
+from elasticsearch.helpers import scan
+
+# damping factor, maximum number of iterations and convergence threshold (L1 norm), pages read per batch
+PAGERANK_DAMPING = float(os.getenv("PAGERANK_DAMPING", 0.85))
+PAGERANK_ITERATIONS = int(os.getenv("PAGERANK_ITERATIONS", 100))
+PAGERANK_TOLERANCE = float(os.getenv("PAGERANK_TOLERANCE", 1e-6))
+PAGERANK_BATCH = int(os.getenv("PAGERANK_BATCH", 1000))
+
+def pages(client) :
+    """
+    All indexed pages, as (index, url) (index is the alias of a language).
+    """
+    for lang in sorted(languages) :
+        index = schema.alias(lang)
+        if not client.indices.exists(index=index) :
+            continue
+        for hit in scan(client, index=index, doc_type="page", query={"query":{"match_all":{}}, "_source":False}) :
+            yield index, hit["_id"]
+
+def graph(redis_conn, links) :
+    """
+    Edges (source and target node arrays) between a list of pages, from their saved outgoing links.
+    Links are compared normalized, links to pages not indexed and links of a page to itself are dropped.
+    """
+    nodes = dict((url.normalize(link) or link, i) for i, link in enumerate(links))
+    sources, targets = [], []
+    for start in range(0, len(links), PAGERANK_BATCH) :
+        batch = links[start:start+PAGERANK_BATCH]
+        for i, outlinks in enumerate(freshness.links_many(redis_conn, batch), start) :
+            for target in set(nodes.get(url.normalize(outlink) or outlink) for outlink in outlinks) :
+                if target is not None and target != i :
+                    sources.append(i)
+                    targets.append(target)
+    return np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64)
+
+def pagerank(count, sources, targets, damping=None, iterations=None, tolerance=None) :
+    """
+    PageRank of count nodes linked by edges (sources -> targets), by power iteration.
+    Rank of pages without outgoing links is shared between all pages. Return ranks scaled to a mean of 1.
+    """
+    damping = damping or PAGERANK_DAMPING
+    iterations = iterations or PAGERANK_ITERATIONS
+    tolerance = tolerance or PAGERANK_TOLERANCE
+    if not count :
+        return np.zeros(0)
+
+    # transition matrix : column j holds the share of rank given by page j to each of its targets
+    out_degree = np.bincount(sources, minlength=count).astype(np.float64)
+    matrix = sparse.csr_matrix((1.0 / out_degree[sources], (targets, sources)), shape=(count, count))
+    dangling = out_degree == 0
+
+    rank = np.full(count, 1.0 / count)
+    for iteration in range(iterations) :
+        new_rank = damping * (matrix.dot(rank) + rank[dangling].sum() / count) + (1 - damping) / count
+        delta = np.abs(new_rank - rank).sum()
+        rank = new_rank
+        if delta < tolerance :
+            break
+    print("pagerank : %s pages, %s links, %s iterations"%(count, len(sources), iteration + 1))
+    return rank * count
+
+def update(client, redis_conn) :
+    """
+    Compute the rank of all indexed pages, and write it into pages.
+    """
+    start = time.time()
+    indices, links = [], []
+    for index, link in pages(client) :
+        indices.append(index)
+        links.append(link)
+    sources, targets = graph(redis_conn, links)
+    ranks = pagerank(len(links), sources, targets)
+
+    sink = BulkIndexer(client, redis_conn=redis_conn)
+    for index, link, rank in zip(indices, links, ranks) :
+        sink.add(index=index, doc_type="page", id=link, body={"rank":float(rank)}, action="update")
+    sink.flush()
+    print("pagerank : %s pages updated, %s errors, in %.1fs"%(sink.indexed, sink.failed, time.time() - start))
+
+if __name__ == '__main__':
+    import clients
+    update(clients.elastic, clients.redis_conn)
@@ -1,74 +1,84 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+# fields of a page read by search results (page bodies are never returned)
+SOURCE = ["url", "domain", "title", "description", "snippet", "thumbnail"]
+
+# precomputed static score of a page, multiplied with the score of query : weight (content quality, 0 to 3)
+# and rank (link popularity, mean 1, see pagerank.py)
+STATIC_SCORE = [
+    {"field_value_factor": {"field": "weight", "missing": 0}},
+    {"field_value_factor": {"field": "rank", "modifier": "log2p", "missing": 1}}
+]
+
+# best pages of a domain in results of an expression query
+DOMAIN_HITS = 3
+
+# highlighting of description or body (title is not highlighted in results) : one fragment per field,
+# from offsets indexed with pages (unified highlighter, pages are not analyzed again at search time)
+HIGHLIGHT = {
+    "type" : "unified",
+    "pre_tags" : ["<b>"],
+    "post_tags" : ["</b>"],
+    "number_of_fragments" : 1,
+    "fields" : {
+        "description" : {"fragment_size" : 180},
+        "body" : {"fragment_size" : 180}
+    }
+}
+
 def expression_query(expression) :
+    """
+    Query of an expression, with the best pages of each domain (DOMAIN_HITS, in inner hits "domain").
+    Results are collapsed on domain, so pagination (from/size) of domains is done by ElasticSearch,
+    and the total is the number of matching domains.
+    Rescoring can't be used with collapsing, so the cross fields match is a should clause
+    and the static score of page a function score.
+    """
     return {
       "query": {
-        "multi_match" : {
-          "query":    expression,
-          "type":       "best_fields",
-          "fields": [ "title^3", "description^2", "body" ]
-        }
-      },
-      "rescore" : [{
-          "query" : {
-             "rescore_query" : {
+        "function_score": {
+          "query": {
+            "bool": {
+              "must": {
+                "multi_match" : {
+                  "query":    expression,
+                  "type":       "best_fields",
+                  "fields": [ "title^3", "description^2", "body" ]
+                }
+              },
+              "should": {
                 "multi_match" : {
                   "query": expression,
                   "type":       "cross_fields",
                   "fields": [ "title", "description", "body" ],
-                  "minimum_should_match":"100%"
+                  "minimum_should_match":"100%",
+                  "boost": 3
                 }
-             },
-             "query_weight" : 0.5,
-             "rescore_query_weight" : 1.5
-          }
-       },
-       {
-          "query" : {
-             "score_mode": "multiply",
-             "rescore_query" : {
-                "function_score" : {
-                   "script_score": {
-                      "script": {
-                        "inline": "_score*doc.weight.value"
-                      }
-                   }
-                }
-             }
-          }
-       } ],
-      "size": 0,
-      "aggs":{
-        "per_domain":{
-          "terms": {
-            "field": "domain",
-            "order": {
-              "top_hit": "desc"
+              }
             }
           },
-          "aggs": {
-                "top_results": {
-                    "top_hits": {
-                        "highlight" : {
-                            "pre_tags" : ["<b>"],
-                            "post_tags" : ["</b>"],
-                            "fields" : {
-                                "title" : {"fragment_size" : 180},
-                                "description" : {"fragment_size" : 180},
-                                "body" : {"fragment_size" : 180}
-                            }
-                        }
-                    }
-                },
-                "top_hit" : {
-                  "max": {
-                    "script": {
-                      "inline": "_score"
-                    }
-                  }
-                }
-            }
+          "functions": STATIC_SCORE,
+          "score_mode": "multiply",
+          "boost_mode": "multiply"
+        }
+      },
+      "collapse": {
+        "field": "domain",
+        "inner_hits": {
+          "name": "domain",
+          "size": DOMAIN_HITS,
+          "_source": SOURCE,
+          "highlight": HIGHLIGHT
+        }
+      },
+      "_source": False,
+      "aggs": {
+        "domains": {
+          "cardinality": {
+            "field": "domain",
+            "precision_threshold": 40000
+          }
         }
       }
     }
@@ -78,36 +88,38 @@ def domain_query(domain) :
         "query": {
             "term" : { "domain":domain}
         },
+        "_source": SOURCE,
         "sort" : [
-          {"weight" : {"order" : "desc"}}
+          {"weight" : {"order" : "desc"}},
+          {"rank" : {"order" : "desc", "missing" : 1, "unmapped_type" : "float"}}
         ]
     }
 
 def domain_expression_query(domain, expression) :
     return {
         "query": {
-            "bool":{
-                "must":{
-                    "multi_match" : {
-                      "query":    expression,
-                      "type":       "best_fields",
-                      "fields": [ "title^3", "description^2", "body" ]
+            "function_score": {
+                "query": {
+                    "bool":{
+                        "must":{
+                            "multi_match" : {
+                              "query":    expression,
+                              "type":       "best_fields",
+                              "fields": [ "title^3", "description^2", "body" ]
+                            }
+                        },
+                        "filter":{
+                            "term": {"domain": domain}
+                        }
                     }
                 },
-                "filter":{
-                    "term": {"domain": domain}
-                }
-            }
-        },
-        "highlight" : {
-            "pre_tags" : ["<b>"],
-            "post_tags" : ["</b>"],
-            "fields" : {
-                "title" : {"fragment_size" : 180},
-                "description" : {"fragment_size" : 180},
-                "body" : {"fragment_size" : 180}
+                "functions": STATIC_SCORE,
+                "score_mode": "multiply",
+                "boost_mode": "multiply"
             }
         },
+        "_source": SOURCE,
+        "highlight" : HIGHLIGHT,
         "rescore" : [{
           "query" : {
              "rescore_query" : {
@@ -121,19 +133,5 @@ def domain_expression_query(domain, expression) :
              "query_weight" : 0.5,
              "rescore_query_weight" : 1.5
           }
-        },
-        {
-          "query" : {
-             "score_mode": "multiply",
-             "rescore_query" : {
-                "function_score" : {
-                   "script_score": {
-                      "script": {
-                        "inline": "_score*doc.weight.value"
-                      }
-                   }
-                }
-             }
-          }
         } ]
     }
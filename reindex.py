@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Zero-downtime reindex of the pages of a language, into a new index of current mapping version (see schema.py).
+Searches keep reading the alias "web-<language code>" on the current index during the whole copy :
+    - the new index is created with refresh and replicas disabled
+    - documents are copied by parallel sliced scrolls (REINDEX_SLICES slices, one thread each)
+      and bulk writes, throttled to REINDEX_RATE documents per second (0 : no limit)
+    - progress is printed every REINDEX_PROGRESS seconds
+    - pages written during the copy (crawls, thumbnails, ranks) are recorded, then copied again
+    - once the copy is complete, settings are restored and the alias is moved in one atomic operation
+Pages written between the last catch-up and the move of the alias forget their content hash (see freshness.py),
+so they are indexed into the new index at their next crawl, even if unchanged.
+The old versioned index is kept (delete it once the new one is validated). An index named as the alias
+(created before versioned indices) is deleted by the move of the alias, an alias can't share its name.
+
+Usage :
+    HOST=<ip> PORT=<port> USERNAME=<username> PASSWORD=<password> python reindex.py [lang ...]
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import sys
+import time
+import threading
+import cache
+import schema
+import freshness
+from bulk import BulkIndexer
+from language import languages
+from elasticsearch.helpers import scan
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# number of parallel slices, maximum of documents copied per second (0 : no limit), documents per scroll request,
+# scroll lifetime and delay between two progress reports (seconds)
+REINDEX_SLICES = int(os.getenv("REINDEX_SLICES", 4))
+REINDEX_RATE = float(os.getenv("REINDEX_RATE", 0))
+REINDEX_BATCH = int(os.getenv("REINDEX_BATCH", 1000))
+REINDEX_SCROLL = os.getenv("REINDEX_SCROLL", "5m")
+REINDEX_PROGRESS = float(os.getenv("REINDEX_PROGRESS", 10))
+
+# maximum number of catch-up passes (copy of pages written during the previous pass)
+REINDEX_CATCHUP_PASSES = int(os.getenv("REINDEX_CATCHUP_PASSES", 5))
+
+# lifetime (seconds) of the record of written pages, extended while the reindex runs
+REINDEX_RECORD_TTL = 3600
+
+class Throttle(object):
+    """
+    Token bucket shared by all slices : at most rate documents per second (no limit if rate is 0).
+    """
+    def __init__(self, rate) :
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self, count) :
+        if not self.rate :
+            return
+        with self.lock :
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - count
+            self.last = now
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay :
+            time.sleep(delay)
+
+class Progress(object):
+    """
+    Documents copied and in error, for all slices.
+    """
+    def __init__(self, total) :
+        self.total = total
+        self.copied = 0
+        self.failed = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, copied, failed) :
+        with self.lock :
+            self.copied += copied
+            self.failed += failed
+
+    def report(self, source, target) :
+        elapsed = time.time() - self.start
+        rate = self.copied / elapsed if elapsed else 0
+        remaining = (self.total - self.copied) / rate if rate else 0
+        print("%s -> %s : %s/%s documents (%.0f/s, %s errors, %.0fs remaining)"%(
+            source, target, self.copied, self.total, rate, self.failed, max(remaining, 0)))
+
+def copy_slice(client, source, target, slice_id, slices, throttle, progress) :
+    """
+    Copy a slice of the documents of source index into target index.
+    """
+    query = {"query":{"match_all":{}}}
+    if slices > 1 :
+        query["slice"] = {"id":slice_id, "max":slices}
+    sink = BulkIndexer(client, max_docs=REINDEX_BATCH, interval=float("inf"))
+    copied = failed = 0
+    for hit in scan(client, index=source, query=query, size=REINDEX_BATCH, scroll=REINDEX_SCROLL) :
+        sink.add(index=target, doc_type=hit["_type"], id=hit["_id"], body=hit["_source"])
+        if sink.indexed + sink.failed > copied + failed : # a bulk request was sent
+            throttle.wait(sink.indexed + sink.failed - copied - failed)
+            progress.add(sink.indexed - copied, sink.failed - failed)
+            copied, failed = sink.indexed, sink.failed
+    sink.flush()
+    progress.add(sink.indexed - copied, sink.failed - failed)
+
+def record(redis_conn, alias, enabled) :
+    """
+    Start (or extend) or stop the record of pages written into alias (see schema.record_writes).
+    """
+    flag, written = "schema:reindex:%s"%alias, "schema:reindex:%s:written"%alias
+    if enabled :
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.set(flag, 1, ex=REINDEX_RECORD_TTL)
+        pipe.expire(written, REINDEX_RECORD_TTL)
+        pipe.execute()
+    else :
+        redis_conn.delete(flag, written)
+
+def written(redis_conn, alias, count) :
+    """
+    Pop at most count ids of pages written into alias since the copy started.
+    """
+    return [id.decode("utf8") for id in redis_conn.spop("schema:reindex:%s:written"%alias, count)]
+
+def catch_up(client, redis_conn, alias, source, target) :
+    """
+    Copy again pages written into source since the copy started : one pass copies the pages recorded
+    when it starts, until none is left (or REINDEX_CATCHUP_PASSES passes).
+    Return the number of pages copied, or None on error.
+    """
+    copied = 0
+    for catch_up_pass in range(REINDEX_CATCHUP_PASSES) :
+        remaining = redis_conn.scard("schema:reindex:%s:written"%alias)
+        if not remaining :
+            break
+        while remaining > 0 :
+            ids = written(redis_conn, alias, min(REINDEX_BATCH, remaining))
+            if not ids :
+                break
+            remaining -= len(ids)
+            sink = BulkIndexer(client, max_docs=REINDEX_BATCH, interval=float("inf"))
+            for doc in client.mget(index=source, doc_type="page", body={"ids":ids})["docs"] :
+                if doc.get("found") :
+                    sink.add(index=target, doc_type="page", id=doc["_id"], body=doc["_source"])
+            sink.flush()
+            if sink.failed :
+                return None
+            copied += sink.indexed
+        record(redis_conn, alias, True)
+    return copied
+
+def reindex(client, redis_conn, lang, slices=None, rate=None) :
+    """
+    Reindex the pages of a language into an index of current mapping version, then move its alias
+    (an old index named as the alias is deleted).
+    Return True if the alias was moved.
+    """
+    slices = slices or REINDEX_SLICES
+    rate = REINDEX_RATE if rate is None else rate
+    alias = schema.alias(lang)
+    source = schema.concrete_index(client, lang)
+    target = schema.index_name(lang)
+    if source is None or source == target :
+        print("%s : nothing to reindex"%alias)
+        return False
+
+    # new index, settings relaxed during copy (an index left by a failed reindex is dropped, no alias is on it)
+    if client.indices.exists(index=target) :
+        print("%s : dropping index of a previous reindex"%target)
+        client.indices.delete(index=target)
+    settings = schema.index_settings(lang)
+    settings.update({"refresh_interval":"-1", "number_of_replicas":0})
+    client.indices.create(index=target, body={"settings":settings})
+    schema.page_mapping(lang).save(target)
+
+    # parallel copy, with progress (pages written from now on are recorded, and copied again after)
+    record(redis_conn, alias, True)
+    progress = Progress(client.count(index=source)["count"])
+    throttle = Throttle(rate)
+    executor = ThreadPoolExecutor(max_workers=slices)
+    futures = [executor.submit(copy_slice, client, source, target, i, slices, throttle, progress) for i in range(slices)]
+    while wait(futures, timeout=REINDEX_PROGRESS).not_done :
+        progress.report(source, target)
+        record(redis_conn, alias, True)
+    executor.shutdown()
+    progress.report(source, target)
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors or progress.failed :
+        record(redis_conn, alias, False)
+        print("%s : reindex failed, alias not moved (%s)"%(target, errors[0] if errors else "%s documents in error"%progress.failed))
+        return False
+
+    # copy again pages written during the copy
+    copied = catch_up(client, redis_conn, alias, source, target)
+    if copied is None :
+        record(redis_conn, alias, False)
+        print("%s : reindex failed, alias not moved (catch-up documents in error)"%target)
+        return False
+    print("%s -> %s : %s documents written during copy, copied again"%(source, target, copied))
+
+    # restore settings, then move alias atomically (an index created before versioned indices is replaced)
+    settings = schema.index_settings(lang)
+    client.indices.put_settings(index=target, body={"index":{
+        "refresh_interval":settings["refresh_interval"], "number_of_replicas":settings["number_of_replicas"]}})
+    client.indices.refresh(index=target)
+    actions = [{"add":{"index":target, "alias":alias}}]
+    if source == alias :
+        actions.append({"remove_index":{"index":source}})
+    else :
+        actions.append({"remove":{"index":source, "alias":alias}})
+    client.indices.update_aliases(body={"actions":actions})
+    cache.invalidate(redis_conn, [alias])
+
+    # pages written since the last catch-up are only in the old index : indexed again at their next crawl
+    missed = []
+    while True :
+        ids = written(redis_conn, alias, REINDEX_BATCH)
+        if not ids :
+            break
+        missed.extend(ids)
+    record(redis_conn, alias, False)
+    freshness.forget(redis_conn, missed)
+    if missed :
+        print("%s : %s documents written during the move, indexed again at their next crawl"%(alias, len(missed)))
+    print("%s : alias moved to %s"%(alias, target))
+    if source != alias :
+        print("%s : old index kept, delete it once %s is validated"%(source, target))
+    else :
+        print("%s : old index deleted, replaced by the alias"%source)
+    return True
+
+if __name__ == '__main__':
+    import clients
+    for lang in sys.argv[1:] or sorted(languages) :
+        reindex(clients.elastic, clients.redis_conn, lang)
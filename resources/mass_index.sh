@@ -1,14 +1,11 @@
 #!/bin/bash
 
-# Index a list of URLs from a file
+# Index a list of URLs from a file, sent in one batch
 # usage : ./mass_index.sh <filename> <lang> <ip> <port>
 # where :
 # - <lang> is the lang of URLs content
 # - <ip> + <port> is the path to search engine API
+# Return the batch id, progress can be followed at http://<ip>:<port>/index/batch/<id>
 
 filename="$1"
-while read -r line
-do
-    name="$line"
-    curl -X POST -F "url=$name" -F "language=$2" "http://$3:$4/index"
-done < "$filename"
+curl -X POST -H "Content-Type: text/plain" -H "Transfer-Encoding: chunked" --data-binary "@$filename" "http://$3:$4/index/batch"
@@ -3,11 +3,16 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 
 import os
+import clients
+import metrics
 from rq import Connection, Queue, Worker
-from redis import Redis
 
 if __name__ == '__main__':
+    # serve metrics on METRICS_PORT, if any
+    if os.getenv("METRICS_PORT") :
+        metrics.serve(int(os.getenv("METRICS_PORT")), clients.redis_conn)
+
     # Tell rq what Redis connection to use
-    with Connection(connection=Redis(os.getenv("REDIS_HOST", "redis"), os.getenv("REDIS_PORT", 6379))):
+    with Connection(connection=clients.redis_conn):
         q = Queue()
         Worker(q).work()
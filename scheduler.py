@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Recrawl scheduler - a process feeding the crawl queue with domains and pages due for a recrawl.
+Domains (explored again) and pages (indexed again) are kept in Redis priority queues, ordered by next due time.
+The revisit interval of each domain and page adapts to how often its content actually changes :
+shorter when changes are seen, longer when nothing changed.
+Crawls are queued at a global rate (SCHEDULER_RATE, per second), and only while the crawl queue is not full.
+
+Usage :
+    python scheduler.py seed # add all explored domains (web index), due at last_crawl + interval
+    python scheduler.py      # run the scheduler
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import sys
+import time
+import url
+
+# revisit intervals (seconds) : initial, minimum and maximum, for domains and pages
+DOMAIN_INTERVAL = float(os.getenv("SCHEDULER_DOMAIN_INTERVAL", 7*24*3600))
+PAGE_INTERVAL = float(os.getenv("SCHEDULER_PAGE_INTERVAL", 3*24*3600))
+MIN_INTERVAL = float(os.getenv("SCHEDULER_MIN_INTERVAL", 3600))
+MAX_INTERVAL = float(os.getenv("SCHEDULER_MAX_INTERVAL", 60*24*3600))
+
+# global rate of queued crawls (per second) and maximum number of jobs waiting in crawl queue
+RATE = float(os.getenv("SCHEDULER_RATE", 5))
+MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", 1000))
+
+# pop members of a schedule whose due time is passed, in one atomic step
+DUE_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1], 'LIMIT', 0, ARGV[2])
+if #members > 0 then
+    redis.call('ZREM', KEYS[1], unpack(members))
+end
+return members
+"""
+
+def adapt(interval, changed, unchanged) :
+    """
+    New revisit interval, given the number of changed and unchanged pages seen since last visit.
+    """
+    if changed + unchanged == 0 : # nothing seen (crawl failed ?), keep interval
+        return interval
+    if changed == 0 :
+        interval *= 2
+    else :
+        interval /= 1 + float(changed) / (changed + unchanged)
+    return min(MAX_INTERVAL, max(MIN_INTERVAL, interval))
+
+def observe(redis_conn, link, changed) :
+    """
+    Record a crawled page (changed or not since last crawl) and schedule its next crawl.
+    """
+    interval = float(redis_conn.hget("schedule:interval:pages", link) or PAGE_INTERVAL)
+    interval = adapt(interval, int(changed), int(not changed))
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hset("schedule:interval:pages", link, interval)
+    pipe.zadd("schedule:pages", {link:time.time()+interval})
+    pipe.hincrby("schedule:changes:%s"%url.domain(link), "changed" if changed else "unchanged")
+    pipe.execute()
+
+def add_domain(redis_conn, domain, homepage, due=None) :
+    """
+    Add a domain to the schedule, if not already scheduled.
+    """
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.hsetnx("schedule:homepages", domain, homepage)
+    pipe.zadd("schedule:domains", {domain:due or time.time()+DOMAIN_INTERVAL}, nx=True)
+    pipe.execute()
+
+def reschedule_domain(redis_conn, domain) :
+    """
+    Schedule the next crawl of a domain, from changes seen on its pages since its last crawl.
+    """
+    changes = redis_conn.hgetall("schedule:changes:%s"%domain)
+    changes = dict((name.decode("utf8"), int(count)) for name, count in changes.items())
+    interval = float(redis_conn.hget("schedule:interval:domains", domain) or DOMAIN_INTERVAL)
+    interval = adapt(interval, changes.get("changed", 0), changes.get("unchanged", 0))
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.delete("schedule:changes:%s"%domain)
+    pipe.hset("schedule:interval:domains", domain, interval)
+    pipe.zadd("schedule:domains", {domain:time.time()+interval})
+    pipe.execute()
+
+def due(redis_conn, name, limit) :
+    """
+    Pop at most limit members of a schedule ("domains" or "pages") whose due time is passed.
+    Atomic : with several schedulers, a member is popped by one of them only.
+    """
+    script = redis_conn.register_script(DUE_SCRIPT)
+    members = script(keys=["schedule:%s"%name], args=[time.time(), limit])
+    return [member.decode("utf8") for member in members]
+
+def seed(redis_conn, client) :
+    """
+    Add all explored domains of web index, due at their last crawl date + interval.
+    """
+    from elasticsearch.helpers import scan
+    from datetime import datetime
+    count = 0
+    for hit in scan(client, index="web", doc_type="domain", query={"query":{"match_all":{}}}) :
+        domain = hit["_source"]
+        last_crawl = domain.get("last_crawl")
+        due_time = None
+        if last_crawl :
+            last_crawl = datetime.strptime(last_crawl[:19], "%Y-%m-%dT%H:%M:%S")
+            due_time = time.mktime(last_crawl.timetuple()) + DOMAIN_INTERVAL
+        add_domain(redis_conn, domain["domain"], domain["homepage"], due_time)
+        count += 1
+    print("%s domains scheduled"%count)
+
+def run(redis_conn, submit, queue_length) :
+    """
+    Feed the crawl queue with due domains and pages, at a global rate.
+    submit(type, link) queues a crawl ("explore" or "index"), queue_length() is the number of waiting crawls.
+    """
+    tokens = 0.0
+    last = time.time()
+    while True :
+        # refill token bucket
+        now = time.time()
+        tokens = min(max(RATE, 1), tokens + (now - last) * RATE) # at least one crawl, even below one per second
+        last = now
+        available = int(min(tokens, MAX_QUEUE - queue_length()))
+        if available <= 0 :
+            time.sleep(max(1.0 / RATE, 0.1))
+            continue
+
+        # domains first (they discover new pages), then pages
+        count = 0
+        for domain in due(redis_conn, "domains", available) :
+            homepage = redis_conn.hget("schedule:homepages", domain)
+            if homepage :
+                submit("explore", homepage.decode("utf8"))
+                reschedule_domain(redis_conn, domain)
+                count += 1
+        for link in due(redis_conn, "pages", available - count) :
+            submit("index", link)
+            count += 1
+        tokens -= count
+        if not count :
+            time.sleep(1)
+
+if __name__ == '__main__':
+    from rq import Queue
+    import crawl_daemon
+    import clients
+
+    redis_conn = clients.redis_conn
+
+    if sys.argv[1:] == ["seed"] :
+        seed(redis_conn, clients.elastic)
+        sys.exit(0)
+
+    if os.getenv("CRAWL_BACKEND", "rq") == "daemon" :
+        submit = lambda type_, link : crawl_daemon.submit(redis_conn, type_, link)
+        queue_length = lambda : crawl_daemon.queue_length(redis_conn)
+    else :
+        q = Queue(connection=redis_conn)
+        submit = lambda type_, link : q.enqueue("index.%s_job"%type_, link)
+        queue_length = lambda : len(q)
+    run(redis_conn, submit, queue_length)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Schema of search engine : indices and versioned mappings.
+The version of a mapping is saved in its _meta field. Run a migration to create missing indices
+and update mappings to the current version (once per deploy, not at startup of API or workers).
+The index of a language is also created and mapped the first time a page of this language is indexed,
+and the known indices are cached (in process and in Redis), so indexing never checks them per page.
+
+Pages of a language are read and written through the alias "web-<language code>", on a versioned index
+"web-<language code>-v<version>". A mapping change that can't be applied to an existing index
+(analyzers, index options,...) needs a reindex : a new versioned index is built from the current one,
+then the alias is moved to it in one atomic operation (see reindex.py).
+
+Settings of indices can be set for all languages, or per language (suffix _<language code>) :
+    - INDEX_SHARDS, INDEX_SHARDS_FR,... : number of shards (5 by default)
+    - INDEX_REPLICAS, INDEX_REPLICAS_FR,... : number of replicas (1 by default)
+    - INDEX_REFRESH_INTERVAL, INDEX_REFRESH_INTERVAL_FR,... : refresh interval (1s by default)
+    - INDEX_BULK_REFRESH_INTERVAL : refresh interval during mass indexing (-1 by default, no refresh)
+
+Usage :
+    python schema.py migrate           # create indices and save mappings
+    python schema.py status            # print mapping version of each index
+    python schema.py reindex [lang]    # reindex into an index of current version (all indices by default)
+    python schema.py bulk-start [lang] # relax refresh interval before a mass indexing (all indices by default)
+    python schema.py bulk-end [lang]   # restore refresh interval after a mass indexing
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import sys
+import time
+import cache
+import metrics
+from elasticsearch.exceptions import RequestError
+from elasticsearch_dsl import Index, Mapping
+from language import languages
+
+# current version of mappings (increase on each mapping change)
+SCHEMA_VERSION = 5
+
+# languages with an index created by migration
+SCHEMA_LANGUAGES = os.getenv("SCHEMA_LANGUAGES", "fr").split(",")
+
+# in-process cache of indices known to exist with a mapping up to date
+known_indices = set()
+
+# in-process cache of indices whose mapping was rejected (reindex needed) : {index:time of next try},
+# and delay between two tries (seconds)
+rejected_indices = {}
+SCHEMA_RETRY_INTERVAL = float(os.getenv("SCHEMA_RETRY_INTERVAL", 300))
+
+def setting(name, lang, default) :
+    """
+    Setting of the index of a language, from environment (per language or for all languages).
+    """
+    return os.getenv("%s_%s"%(name, lang.upper()), os.getenv(name, default))
+
+def index_settings(lang) :
+    """
+    Settings of the index of a language, at creation.
+    """
+    return {
+        "number_of_shards":int(setting("INDEX_SHARDS", lang, 5)),
+        "number_of_replicas":int(setting("INDEX_REPLICAS", lang, 1)),
+        "refresh_interval":setting("INDEX_REFRESH_INTERVAL", lang, "1s")
+    }
+
+def alias(lang) :
+    """
+    Alias of the pages of a language (read and written through it).
+    """
+    return 'web-%s'%lang
+
+def index_name(lang, version=None) :
+    """
+    Versioned index of the pages of a language.
+    """
+    return 'web-%s-v%s'%(lang, version or SCHEMA_VERSION)
+
+def concrete_index(client, lang) :
+    """
+    Index behind the alias of a language (or index named as alias, created before versioned indices), None if no index.
+    """
+    if not client.indices.exists(index=alias(lang)) :
+        return None
+    return sorted(client.indices.get(index=alias(lang)).keys())[0]
+
+def create_index(client, lang) :
+    """
+    Create the versioned index of a language, with its settings, page mapping and alias (no error if index already exists).
+    The mapping is part of the creation, so pages indexed at once never get a dynamic mapping.
+    """
+    body = {"settings":index_settings(lang), "mappings":page_mapping(lang).to_dict(), "aliases":{alias(lang):{}}}
+    try :
+        client.indices.create(index=index_name(lang), body=body)
+    except RequestError as e :
+        if "already_exists" not in str(e.error) :
+            raise
+
+def save_mapping(index, lang) :
+    """
+    Save the page mapping on an index.
+    Return False if the mapping can't be applied to this index (reindex needed).
+    """
+    try :
+        page_mapping(lang).save(index)
+    except RequestError as e :
+        if e.error != "illegal_argument_exception" :
+            raise
+        print("%s : mapping %s needs a reindex (python schema.py reindex %s) : %s"%(index, SCHEMA_VERSION, lang, e.info))
+        return False
+    return True
+
+def ensure_index(client, redis_conn, lang) :
+    """
+    Create and map the index of a language, the first time it is needed.
+    If the mapping can't be applied (reindex needed), pages are still indexed with the mapping
+    of the index, and the mapping is tried again after SCHEMA_RETRY_INTERVAL seconds.
+    Return the index name (alias).
+    """
+    index = alias(lang)
+    if index in known_indices or rejected_indices.get(index, 0) > time.time() :
+        return index
+    member = "%s:%s"%(index, SCHEMA_VERSION)
+    if not redis_conn.sismember("schema:indices", member) :
+        current = version(client, index, 'page')
+        if current is None :
+            create_index(client, lang)
+        elif current != SCHEMA_VERSION and not save_mapping(index, lang) :
+            print("ERROR : %s indexed with mapping %s instead of %s, reindex it"%(index, current, SCHEMA_VERSION))
+            metrics.incr("schema_mapping_errors")
+            rejected_indices[index] = time.time() + SCHEMA_RETRY_INTERVAL
+            return index
+        redis_conn.sadd("schema:indices", member)
+    rejected_indices.pop(index, None)
+    known_indices.add(index)
+    return index
+
+def record_writes(redis_conn, written) :
+    """
+    Record the pages written into indices being reindexed (see reindex.py), to copy them again.
+    written : ids of pages written, per index (alias).
+    """
+    indices = sorted(written)
+    flags = redis_conn.mget(["schema:reindex:%s"%index for index in indices])
+    pipe = redis_conn.pipeline(transaction=False)
+    for index, flag in zip(indices, flags) :
+        if flag is not None and written[index] :
+            pipe.sadd("schema:reindex:%s:written"%index, *written[index])
+    pipe.execute()
+
+def bulk_mode(client, langs, enabled, redis_conn=None) :
+    """
+    Relax (enabled) or restore the refresh interval of indices, around a mass indexing.
+    When restored, indices are refreshed and their cached search results invalidated
+    (pages indexed during the mass indexing were not searchable yet).
+    """
+    for lang in langs :
+        index = alias(lang)
+        if not client.indices.exists(index=index) :
+            continue
+        interval = os.getenv("INDEX_BULK_REFRESH_INTERVAL", "-1") if enabled else setting("INDEX_REFRESH_INTERVAL", lang, "1s")
+        client.indices.put_settings(index=index, body={"index":{"refresh_interval":interval}})
+        print("%s : refresh interval %s"%(index, interval))
+        if not enabled :
+            client.indices.refresh(index=index)
+            if redis_conn is not None :
+                cache.invalidate(redis_conn, [index])
+
+def page_mapping(lang) :
+    """
+    Mapping of page, in index "web-<language code>".
+    """
+    m = Mapping('page')
+    m.meta('meta', {"version":SCHEMA_VERSION})
+    m.field('url', 'keyword')
+    m.field('domain', 'keyword')
+    # offsets are indexed for highlighting (no re-analysis of pages at search time)
+    m.field('title', 'text', analyzer=languages[lang], index_options='offsets')
+    m.field('description', 'text', analyzer=languages[lang], index_options='offsets')
+    m.field('body', 'text', analyzer=languages[lang], index_options='offsets')
+    m.field('snippet', 'text', index=False) # displayed only
+    m.field('weight', 'long')
+    m.field('rank', 'float') # see pagerank.py
+    #m.field('thumbnail', 'binary')
+    m.field('suggest', 'completion', analyzer='simple') # query autocomplete (see suggest.py)
+    return m
+
+def domain_mapping() :
+    """
+    Mapping of domain, in index "web".
+    """
+    m = Mapping('domain')
+    m.meta('meta', {"version":SCHEMA_VERSION})
+    m.field('homepage', 'keyword')
+    m.field('domain', 'keyword')
+    m.field('email', 'keyword')
+    m.field('last_crawl', 'date')
+    #m.field('keywords', 'text', analyzer=languages[lang])
+    return m
+
+def version(client, index, doc_type) :
+    """
+    Version of the mapping of an index (0 if no mapping or no version, None if no index).
+    """
+    if not client.indices.exists(index=index) :
+        return None
+    mapping = client.indices.get_mapping(index=index, doc_type=doc_type)
+    mapping = list(mapping.values())[0]["mappings"] if mapping else {}
+    return mapping.get(doc_type, {}).get("_meta", {}).get("version", 0)
+
+def migrate(client) :
+    """
+    Create missing indices, and save mappings not up to date.
+    """
+    targets = [(alias(lang), 'page', page_mapping(lang), lang) for lang in SCHEMA_LANGUAGES]
+    targets.append(('web', 'domain', domain_mapping(), None))
+    for index, doc_type, mapping, lang in targets :
+        current = version(client, index, doc_type)
+        if current is None and lang :
+            create_index(client, lang)
+        elif current is None :
+            Index(index).create()
+        if current == SCHEMA_VERSION :
+            print("%s : mapping %s up to date"%(index, SCHEMA_VERSION))
+            continue
+        if lang :
+            if not save_mapping(index, lang) :
+                continue
+        else :
+            mapping.save(index)
+        print("%s : mapping %s saved (was %s)"%(index, SCHEMA_VERSION, current))
+
+def status(client) :
+    """
+    Print the mapping version of each index.
+    """
+    for lang in sorted(languages) :
+        current = version(client, alias(lang), 'page')
+        if current is not None :
+            print("%s (%s) : %s"%(alias(lang), concrete_index(client, lang), current))
+    print("web : %s"%version(client, 'web', 'domain'))
+
+if __name__ == '__main__':
+    import clients
+    commands = {"migrate":migrate, "status":status}
+    langs = sys.argv[2:] or sorted(languages)
+    if sys.argv[1:2] and sys.argv[1] in commands :
+        commands[sys.argv[1]](clients.elastic)
+    elif sys.argv[1:2] == ["bulk-start"] :
+        bulk_mode(clients.elastic, langs, True)
+    elif sys.argv[1:2] == ["bulk-end"] :
+        bulk_mode(clients.elastic, langs, False, clients.redis_conn)
+    elif sys.argv[1:2] == ["reindex"] :
+        import reindex
+        for lang in langs :
+            reindex.reindex(clients.elastic, clients.redis_conn, lang)
+    else :
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Toolbox for query autocomplete.
+Suggestions come from the completion field of pages (titles and most frequent terms, saved at indexing),
+in the index of each language. The hottest prefixes are kept in an in-process LRU cache
+(SUGGEST_CACHE_SIZE prefixes, for SUGGEST_CACHE_TTL seconds).
+"""
+
+__author__ = "Anthony Sigogne"
+__copyright__ = "Copyright 2017, Byprog"
+__email__ = "anthony@byprog.com"
+__license__ = "MIT"
+__version__ = "1.0"
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from language import languages
+
+# maximum of suggestions, and size and lifetime (seconds) of cache
+SUGGEST_SIZE = int(os.getenv("SUGGEST_SIZE", 10))
+SUGGEST_CACHE_SIZE = int(os.getenv("SUGGEST_CACHE_SIZE", 10000))
+SUGGEST_CACHE_TTL = float(os.getenv("SUGGEST_CACHE_TTL", 60))
+
+class LRUCache(object):
+    """
+    Cache of the last used entries, each one kept at most ttl seconds.
+    """
+    def __init__(self, size, ttl) :
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key) :
+        with self.lock :
+            entry = self.entries.get(key)
+            if entry is None :
+                return None
+            if entry[0] < time.time() :
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value) :
+        with self.lock :
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size :
+                self.entries.popitem(last=False)
+
+cache = LRUCache(SUGGEST_CACHE_SIZE, SUGGEST_CACHE_TTL)
+
+def plan(data) :
+    """
+    Analyze the data of a suggest request (prefix, lang, size).
+    Return prefix, index and size, or raise a ValueError on invalid request.
+    """
+    prefix = " ".join((data.get("prefix") or "").lower().split())
+    if not prefix :
+        raise ValueError('No prefix specified')
+    try :
+        size = min(int(data.get("size") or SUGGEST_SIZE), 100)
+    except ValueError :
+        raise ValueError('Size must be an integer')
+    langs = [lang.strip() for lang in (data.get("lang") or "").split(",") if lang.strip()]
+    for lang in langs :
+        if lang not in languages :
+            raise ValueError('Language not supported : %s'%lang)
+    index = ",".join("web-%s"%lang for lang in (langs or sorted(languages)))
+    return prefix, index, size
+
+def body(prefix, size) :
+    """
+    Elasticsearch completion query of a prefix (more options asked, duplicates are removed).
+    """
+    return {
+        "_source": False,
+        "suggest": {
+            "pages": {
+                "prefix": prefix,
+                "completion": {
+                    "field": "suggest",
+                    "size": size * 3
+                }
+            }
+        }
+    }
+
+def options(response, size) :
+    """
+    Distinct suggestions of an elasticsearch response, best first.
+    """
+    suggestions = []
+    seen = set()
+    for suggestion in response.get("suggest", {}).get("pages", []) :
+        for option in suggestion["options"] :
+            text = option["text"]
+            if text.lower() not in seen :
+                seen.add(text.lower())
+                suggestions.append(text)
+    return suggestions[:size]
+
+def suggest(client, prefix, index, size) :
+    """
+    Suggestions of a prefix, from cache or from elasticsearch.
+    """
+    key = (index, prefix, size)
+    suggestions = cache.get(key)
+    if suggestions is None :
+        response = client.search(index=index, body=body(prefix, size), ignore_unavailable=True)
+        suggestions = options(response, size)
+        cache.put(key, suggestions)
+    return suggestions
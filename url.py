@@ -12,52 +12,260 @@ __license__ = "MIT"
 __version__ = "1.0"
 
 import re
+import os
+import time
 import langdetect
-import html2text
 import requests
 import justext
 import tldextract
+import lxml.html
+from lxml import etree
+from justext.core import preprocessor, ParagraphMaker, classify_paragraphs, revise_paragraph_classification
 from html import unescape
+from collections import Counter
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit, urljoin, urldefrag
+
+# limits of a fetch : timeout in seconds, maximum size of body in bytes and maximum number of redirections
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", 30))
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", 5*1024*1024))
+FETCH_MAX_REDIRECTS = int(os.getenv("FETCH_MAX_REDIRECTS", 10))
+
+# number of characters of text used to detect language of a page
+LANGUAGE_SAMPLE = int(os.getenv("LANGUAGE_SAMPLE", 2000))
+
+# maximum size of a snippet (characters)
+SNIPPET_SIZE = int(os.getenv("SNIPPET_SIZE", 300))
+
+# deterministic language detection
+langdetect.DetectorFactory.seed = 0
+
+# registered domain extraction (public suffix list fetched online on first use, see benchmark.py for an offline one)
+tld_extract = tldextract.extract
 
 def domain(url) :
     """
     Get the domain of the url.
     """
-    return tldextract.extract(url).registered_domain
+    return tld_extract(url).registered_domain
+
+def site(url) :
+    """
+    Domain of a website : registered domain of the url, or its host name if it has none (IP address, localhost).
+    """
+    return domain(url) or urlsplit(url).hostname or ""
 
-def crawl(url) :
+def normalize(url) :
     """
-    Crawl an URL.
-    Return URL data.
+    Normalize an URL (lower case scheme and host, no default port, no fragment).
+    Return None if the URL is not a valid http(s) URL.
     """
+    url = url.strip()
+    if not url :
+        return None
+    if "://" not in url :
+        url = "http://%s"%url
     try :
-        r = requests.get(url)
-    except :
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError :
         return None
-    return r
+    scheme = parts.scheme.lower()
+    if scheme not in ("http", "https") or not parts.hostname or " " in parts.netloc :
+        return None
+    netloc = parts.hostname.lower()
+    if port and (scheme, port) not in (("http", 80), ("https", 443)) :
+        netloc = "%s:%s"%(netloc, port)
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+def read_timeout(r, seconds) :
+    """
+    Bound the next socket read of a streamed response (skipped if its socket is not reachable).
+    """
+    sock = getattr(getattr(r.raw, "_connection", None), "sock", None)
+    if sock is not None :
+        sock.settimeout(max(seconds, 0.001))
 
-def detect_language(html) :
+def fetch(url, headers=None, timeout=None, max_bytes=None) :
     """
-    Detect the language of the text content of a page.
+    Fetch an URL, following redirections, in a single request.
+    The whole download (redirections included) must end within timeout seconds : each redirection
+    and each read of body waits at most the time left.
+    The body is truncated to max_bytes (0 to only get the final URL and headers), response.truncated tells if it was.
+    Return the response (final URL in response.url, body in response.content), or None on error or timeout.
     """
-    # handle string, need bytes
+    timeout = timeout or FETCH_TIMEOUT
+    max_bytes = FETCH_MAX_BYTES if max_bytes is None else max_bytes
+    deadline = time.time() + timeout
+    session = requests.Session()
     try :
-        html = html.decode("utf8")
-    except :
+        for redirection in range(FETCH_MAX_REDIRECTS + 1) :
+            r = session.get(url, headers=headers, stream=True, allow_redirects=False, timeout=max(deadline - time.time(), 0.001))
+            if not r.is_redirect :
+                break
+            url = urljoin(r.url, r.headers["Location"])
+            r.close()
+        else :
+            return None # too many redirections
+
+        chunks, size = [], 0
+        if max_bytes :
+            read_timeout(r, deadline - time.time())
+            for chunk in r.iter_content(chunk_size=8192) :
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > max_bytes :
+                    break
+                if time.time() > deadline :
+                    return None # body incomplete
+                read_timeout(r, deadline - time.time())
+        r.close()
+    except Exception :
+        return None
+    finally :
+        session.close()
+    r._content = b"".join(chunks)[:max_bytes]
+    r.truncated = size > max_bytes
+    return r
+
+def parse(html) :
+    """
+    Parse a page into a lxml tree, once for all extraction steps.
+    Return None if page is not a html document.
+    """
+    if isinstance(html, bytes) :
         try :
+            html = html.decode("utf8")
+        except UnicodeDecodeError :
             html = html.decode("latin1")
-        except :
-            pass
-    h = html2text.HTML2Text()
-    return langdetect.detect(h.handle(html))
+    try :
+        return lxml.html.document_fromstring(html.encode("utf8"), parser=lxml.html.HTMLParser(encoding="utf8"))
+    except (etree.ParserError, ValueError) :
+        return None
+
+def is_tree(html) :
+    """
+    True if html is a parsed page (see parse), else it is a string or bytes.
+    """
+    return not isinstance(html, (str, bytes))
+
+def first(tree, xpath) :
+    """
+    First stripped result of a xpath on tree, or an empty string.
+    """
+    for value in tree.xpath(xpath) :
+        value = value.strip()
+        if value :
+            return value
+    return ""
+
+def extract_metadata(tree) :
+    """
+    Extract title, description, declared language and image (og:image or twitter:image) of a parsed page.
+    """
+    return {
+        "title":first(tree, "//title/text()"),
+        "description":first(tree, "//meta[@name='description']/@content"),
+        "lang":tree.get("lang", ""),
+        "image":first(tree, "//meta[@property='og:image']/@content") or first(tree, "//meta[@name='twitter:image']/@content")
+    }
+
+def extract_links(tree, base) :
+    """
+    Extract the followed links (not "nofollow") of a parsed page, as absolute URLs without fragment.
+    """
+    links = []
+    seen = set()
+    for a in tree.xpath("//a[@href]") :
+        if "nofollow" in (a.get("rel") or "").lower() :
+            continue
+        try :
+            link = urldefrag(urljoin(base, a.get("href").strip()))[0]
+        except ValueError :
+            continue
+        if link.startswith(("http://", "https://")) and link not in seen :
+            seen.add(link)
+            links.append(link)
+    return links
+
+def language_hint(html, headers=None) :
+    """
+    Get the language declared by a page, in <html lang> attribute or in Content-Language header.
+    Return a language code (ex : "fr") or None.
+    """
+    if is_tree(html) :
+        match = re.match("[a-zA-Z]{2,3}", html.get("lang", "").strip())
+    else :
+        if isinstance(html, bytes) :
+            html = html[:4096].decode("latin1")
+        match = re.search("<html[^>]*?\\slang=[\"']?([a-zA-Z]{2,3})", html[:4096], re.I)
+    if match :
+        return match.group(match.lastindex or 0).lower()
+    header = (headers or {}).get("Content-Language")
+    if isinstance(header, bytes) :
+        header = header.decode("latin1")
+    if header :
+        return header.split(",")[0].strip()[:2].lower() or None
+    return None
+
+def text_sample(html, size=None) :
+    """
+    Extract a bounded sample of the text content of a page (no scripts, styles or tags).
+    """
+    size = size or LANGUAGE_SAMPLE
+    if is_tree(html) :
+        text = []
+        length = 0
+        for value in html.xpath("//body//text()[not(ancestor::script) and not(ancestor::style)]") :
+            value = value.strip()
+            if value :
+                text.append(value)
+                length += len(value) + 1
+                if length >= size :
+                    break
+        return " ".join(text)[:size]
+    if isinstance(html, bytes) :
+        html = html.decode("utf8", "ignore")
+    # only process a window of the document, from start of body
+    start = max(html.find("<body"), 0)
+    html = re.sub("(?is)<(script|style)[^>]*>.*?(</\\1>|$)", " ", html[start:start+size*20])
+    text = unescape(re.sub("\\s+", " ", re.sub("<[^>]*>", " ", html)))
+    return text.strip()[:size]
+
+def detect_language(html, headers=None) :
+    """
+    Detect the language of the text content of a page (html or parsed page).
+    Trust the language declared by page if any, otherwise classify a bounded sample of text.
+    """
+    hint = language_hint(html, headers)
+    if hint :
+        return hint
+    try :
+        return langdetect.detect(text_sample(html))
+    except langdetect.LangDetectException :
+        return None # no text
+
+@lru_cache(maxsize=None)
+def get_stoplist(lang) :
+    """
+    Stop words of a language (long form, ex : "french"), read once per process.
+    """
+    return justext.get_stoplist(lang[:1].upper()+lang[1:])
 
 def extract_content(html, lang) :
     """
-    Extract the main text content of a page by removing boilerplate parts.
+    Extract the main text content of a page (html or parsed page) by removing boilerplate parts.
     """
     body = []
     boilerplate = []
-    paragraphs = justext.justext(html, justext.get_stoplist(lang[:1].upper()+lang[1:]))
+    stoplist = get_stoplist(lang)
+    if is_tree(html) :
+        # same steps as justext.justext, on the already parsed page (preprocessor works on a copy)
+        paragraphs = ParagraphMaker.make_paragraphs(preprocessor(html))
+        classify_paragraphs(paragraphs, stoplist)
+        revise_paragraph_classification(paragraphs)
+    else :
+        paragraphs = justext.justext(html, stoplist)
     for p in paragraphs :
         if p.text.count(" ") >= 5 :
             body.append(p.text)
@@ -65,6 +273,14 @@ def extract_content(html, lang) :
             boilerplate.append(p.text)
     return ". ".join(body), ". ".join(boilerplate)
 
+def extract_terms(body, lang, count=10) :
+    """
+    Extract the most frequent terms of the main content of a page (no stop words, at least 4 letters).
+    """
+    stoplist = get_stoplist(lang)
+    terms = Counter(word for word in re.findall("\\w{4,}", body.lower()) if word not in stoplist and not word.isdigit())
+    return [term for term, frequency in terms.most_common(count)]
+
 def extract_title(html) :
     """
     Extract the title of a page.
@@ -89,10 +305,16 @@ def create_description(body) :
     """
     Artificially create a description from main content of page (only, in case of no meta description).
     """
-    # extract all long sentences (possible candidates)
-    candidates = sorted([sentence for sentence in body.split('.')],key=lambda s : s.count(" "), reverse=True)
+    # return the longest sentence (in words)
+    return max(body.split('.'), key=lambda s : s.count(" "))
 
-    # return the best candidate or nothing
-    if not candidates :
-        return None
-    return candidates[0]
+def create_snippet(description, size=None) :
+    """
+    Create the snippet of a page without description, at indexing time (search results never read page bodies) :
+    the description created from main content (see create_description), cut on a word to size characters.
+    """
+    size = size or SNIPPET_SIZE
+    snippet = description.strip()
+    if len(snippet) > size :
+        snippet = snippet[:size].rsplit(" ", 1)[0]
+    return snippet